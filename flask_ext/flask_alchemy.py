@@ -62,6 +62,83 @@ class SqlAlchemy(BaseExtension):
 
         return db
 
+    def missing_schema(self, db):
+        """ Columns and indexes of the models missing in existing tables """
+
+        inspector = sqlalchemy.inspect(db.engine)
+        existing_tables = inspector.get_table_names()
+
+        columns = []
+        indexes = []
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing:
+                    columns.append((table, column))
+            existing = [i['name'] for i in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in existing:
+                    indexes.append((table, index))
+        return columns, indexes
+
+    def upgrade_schema(self, db):
+        """
+        Migrate existing tables to the current models, at project
+        initialization: missing columns are added, then data migrations
+        of the models modules run (an 'upgrade(db)' function, base then
+        custom, if defined), then missing indexes are created
+        """
+
+        columns, indexes = self.missing_schema(db)
+        quote = db.engine.dialect.identifier_preparer.quote
+
+        for table, column in columns:
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            # always nullable: existing rows have no value yet
+            db.engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                quote(table.name), quote(column.name), column_type))
+            log.warning("Added column %s.%s" % (table.name, column.name))
+            if not column.nullable:
+                log.warning("Column %s.%s added as nullable: fill it "
+                            "with an upgrade function"
+                            % (table.name, column.name))
+
+        m = Meta()
+        upgrades = []
+        for package in (BACKEND_PACKAGE, CUSTOM_PACKAGE):
+            upgrade = m.obj_from_models('upgrade', self.name, package)
+            if upgrade is not None and upgrade not in upgrades:
+                upgrades.append(upgrade)
+        for upgrade in upgrades:
+            upgrade(db)
+
+        for table, index in indexes:
+            index.create(bind=db.engine)
+            log.warning("Created index %s" % index.name)
+
+    def check_schema(self, db):
+        """
+        Tables older than the models: missing indexes are only slower,
+        while every query of a model with a missing column would fail
+        (e.g. any login, on the token table), so startup stops
+        """
+
+        columns, indexes = self.missing_schema(db)
+        for table, index in indexes:
+            log.warning("Missing index %s" % index.name)
+        if len(columns) > 0:
+            for table, column in columns:
+                log.error("Missing column %s.%s"
+                          % (table.name, column.name))
+            log.critical_exit(
+                "SQL schema older than the models: "
+                "initialize the project to upgrade it")
+        if len(indexes) > 0:
+            log.warning("Initialize the project to upgrade the SQL schema")
+        return len(indexes) < 1
+
     def custom_init(self, pinit=False, pdestroy=False, **kwargs):
         """ Note: we ignore args here """
 
@@ -79,10 +156,16 @@ class SqlAlchemy(BaseExtension):
             sql = text('SELECT 1')
             db.engine.execute(sql)
 
+            # tables created by a previous version of the models
+            # are changed only at initialization, never by concurrent
+            # workers
             if pinit:
                 # all is fine: now create table
                 # because they should not exist yet
                 db.create_all()
+                self.upgrade_schema(db)
+            elif not pdestroy:
+                self.check_schema(db)
 
             if pdestroy:
                 # massive destruction
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Base tasks, available to any project using the Celery service.
+
+Long operations on iRODS trees (e.g. recursive ACLs) are run here
+to avoid blocking a web worker. Progress is published as the task
+state, so it can be read from the Queue endpoint; when the connection
+to iRODS fails the task retries itself starting from the latest
+checkpoint.
+
+Tasks act as the iRODS user given with 'irods_user' (connected with its
+certificates, as for GSI authentication), which is required: running
+as the service account would bypass the permissions of the requester.
+
+"""
+
+import socket
+from flask_ext import get_logger
+from flask_ext.flask_celery import CeleryExt
+
+log = get_logger(__name__)
+
+celery_app = CeleryExt.celery_app
+
+PROGRESS_STATE = 'PROGRESS'
+MAX_RETRIES = 3
+RETRY_COUNTDOWN = 10
+
+
+def connection_errors():
+    """ Errors worth a retry: the iRODS server could not be reached """
+    from irods.exception import NetworkException
+    return (NetworkException, ConnectionError, socket.timeout)
+
+
+def run_in_batches(task, operation, path, cursor, done,
+                   irods_user=None, **kwargs):
+    """ Run a recursive operation of the iRODS client, publishing progress """
+
+    from flask_ext.flask_irods.client import IrodsException
+    if irods_user is None:
+        raise IrodsException(
+            "%s on %s refused: the iRODS user is required"
+            % (operation, path))
+
+    status = {'checkpoint': cursor, 'done': done}
+
+    def progress(current, checkpoint):
+        status['checkpoint'] = checkpoint
+        status['done'] = done + current
+        task.update_state(state=PROGRESS_STATE, meta={
+            'path': path,
+            'done': status['done'],
+            'checkpoint': checkpoint,
+        })
+
+    icom = None
+    try:
+        # a dedicated session for this user, closed at the end
+        icom = celery_app.get_service('irods', user=irods_user)
+        if icom is None:
+            raise IrodsException(
+                "Unable to connect to iRODS as %s" % irods_user)
+        getattr(icom, operation)(
+            path, cursor=cursor, progress=progress, **kwargs)
+    except connection_errors() as e:
+        log.warning(
+            "%s on %s failed after %s paths: %s"
+            % (operation, path, status['done'], e))
+        # every argument goes in kwargs: positional ones of the
+        # original call would otherwise be given twice
+        raise task.retry(
+            exc=e, countdown=RETRY_COUNTDOWN, args=(),
+            kwargs=dict(
+                kwargs, path=path, irods_user=irods_user,
+                cursor=status['checkpoint'], done=status['done']))
+    finally:
+        if icom is not None:
+            icom.rpc.cleanup()
+
+    return {'path': path, 'done': status['done']}
+
+
+@celery_app.task(bind=True, max_retries=MAX_RETRIES)
+def set_permissions_recursively(self, path, permission, userOrGroup,
+                                zone='', irods_user=None,
+                                cursor=None, done=0):
+    return run_in_batches(
+        self, 'set_permissions_in_batches', path, cursor, done,
+        irods_user=irods_user,
+        permission=permission, userOrGroup=userOrGroup, zone=zone)
+
+
+@celery_app.task(bind=True, max_retries=MAX_RETRIES)
+def set_inheritance_recursively(self, path, inheritance=True,
+                                irods_user=None, cursor=None, done=0):
+    return run_in_batches(
+        self, 'set_inheritance_in_batches', path, cursor, done,
+        irods_user=irods_user, inheritance=inheritance)
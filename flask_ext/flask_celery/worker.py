@@ -27,8 +27,15 @@ celery_app = app.extensions.get('celery').celery_app
 celery_app.app = app
 
 
-def get_service(service):
-    return celery_app.app.extensions.get(service).get_instance()
+def get_service(service, **kwargs):
+    extension = celery_app.app.extensions.get(service)
+    if len(kwargs) < 1:
+        return extension.get_instance()
+    # a dedicated connection, e.g. as a specific user
+    obj = extension.connect(**kwargs)
+    if obj is None:
+        return None
+    return extension.set_models_to_service(obj)
 
 
 celery_app.get_service = get_service
@@ -40,6 +47,8 @@ meta = Meta()
 # main_package = "commons.tasks."
 # # Base tasks
 # submodules = meta.import_submodules_from_package(main_package + "base")
+# Base tasks
+meta.get_module_from_string("flask_ext.flask_celery.tasks")
 # # Custom tasks
 submodules = meta.import_submodules_from_package("%s.tasks" % CUSTOM_PACKAGE)
 
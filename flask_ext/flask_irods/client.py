@@ -1,27 +1,116 @@
 # -*- coding: utf-8 -*-
 
 import os
-from functools import lru_cache
+import base64
+import hashlib
+import time
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from rapydo.utils import htmlcodes as hcodes
+from rapydo.utils.downloads import requested_range, content_disposition
 from irods.access import iRODSAccess
+from irods.column import Like, In
+from irods.meta import iRODSMeta, AVUOperation
 from irods.models import User, UserGroup, UserAuth
+from irods.models import Collection, DataObject, DataObjectMeta
+from irods.models import CollectionUser, CollectionAccess, DataAccess
 from irods import exception as iexceptions
+from irods import keywords as kw
 from rapydo.exceptions import RestApiException
+from rapydo.utils.metrics import DEFAULT_SLOW_THRESHOLD
+from flask_ext.flask_irods.monitoring import InstrumentedSession
 
 from rapydo.utils.logs import get_logger
 log = get_logger(__name__)
 
+# 1 MB: a reasonable trade-off between network round-trips and memory
+DEFAULT_CHUNK_SIZE = 1048576
+# GenQuery rows fetched for each round-trip when iterating listings
+DEFAULT_BATCH_SIZE = 500
+
+
+# seconds a path stat is trusted, when not invalidated by the client itself
+DEFAULT_STAT_CACHE_TTL = 3
+# paths kept at most in the stat cache
+DEFAULT_STAT_CACHE_SIZE = 10000
+# parallel requests when verifying checksums in bulk
+DEFAULT_CHECKSUM_WORKERS = 4
+# seconds before cached user information and groups are read again
+DEFAULT_USERS_CACHE_TTL = 120
+# users (existing or not) kept at most in the users cache
+DEFAULT_USERS_CACHE_SIZE = 10000
+
 
 class IrodsException(RestApiException):
     pass
 
 
+class UsersCache(object):
+    """
+    Process-wide cache of iRODS users (and their groups),
+    keyed by (zone, username) and shared across sessions.
+
+    Missing users are cached as None; use MISSING to tell
+    an empty slot from a non existing user.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size=DEFAULT_USERS_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, zone, username):
+        with self._lock:
+            value, expiration = self._data.get(
+                (zone, username), (self.MISSING, 0))
+            if expiration < time.time():
+                return self.MISSING
+            return value
+
+    def set(self, zone, username, value, ttl=DEFAULT_USERS_CACHE_TTL):
+        with self._lock:
+            self._data.pop((zone, username), None)
+            self.prune()
+            self._data[(zone, username)] = (value, time.time() + ttl)
+
+    def prune(self):
+        """ Any name can be probed: the cache must stay bounded """
+
+        if len(self._data) < self.max_size:
+            return
+        now = time.time()
+        for key, (_, expiration) in list(self._data.items()):
+            if expiration <= now:
+                self._data.pop(key, None)
+        # still full: drop the oldest entries
+        while len(self._data) >= self.max_size:
+            self._data.pop(next(iter(self._data)), None)
+
+    def invalidate(self, zone, username):
+        with self._lock:
+            self._data.pop((zone, username), None)
+
+
+users_cache = UsersCache()
+
+
 class IrodsPythonClient():
 
+    # kinds of rows a listing cursor can point to
+    CURSOR_COLLECTIONS = 'c'
+    CURSOR_DATAOBJECTS = 'd'
+
     def __init__(self, rpc, variables):
-        self.rpc = rpc
         self.variables = variables
+        threshold = float(variables.get(
+            'slow_call_threshold', DEFAULT_SLOW_THRESHOLD))
+        self.rpc = InstrumentedSession(rpc, threshold)
+        # path: (stat, expiration)
+        self._stats = {}
 
     def connect(self):
         return self
@@ -41,17 +130,81 @@ class IrodsPythonClient():
 # Re-implemented wrappers
 # ##################################
 # ##################################
+    def stat(self, path):
+        """
+        Type, size and checksum of a path, or None if missing.
+
+        Results are kept for a few seconds (IRODS_STAT_CACHE_TTL) and
+        invalidated by the mutations of this client, so that the checks
+        done by a single REST call do not query the catalog every time.
+        """
+
+        if path != '/':
+            path = path.rstrip('/')
+
+        cached = self._stats.get(path)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+
+        result = None
+        if self.rpc.query(Collection.id) \
+                .filter(Collection.name == path).first() is not None:
+            result = {
+                'path': path,
+                'type': 'collection',
+                'size': None,
+                'checksum': None,
+            }
+        else:
+            obj = self.rpc.query(
+                DataObject.size, DataObject.checksum
+            ).filter(Collection.name == self.get_collection_from_path(path)) \
+             .filter(DataObject.name == os.path.basename(path)).first()
+            if obj is not None:
+                result = {
+                    'path': path,
+                    'type': 'dataobject',
+                    'size': obj[DataObject.size],
+                    'checksum': obj[DataObject.checksum],
+                }
+
+        ttl = float(self.variables.get(
+            'stat_cache_ttl', DEFAULT_STAT_CACHE_TTL))
+        self.prune_stats()
+        self._stats[path] = (result, time.time() + ttl)
+        return result
+
+    def prune_stats(self, max_size=DEFAULT_STAT_CACHE_SIZE):
+        """ Long lived clients would otherwise keep every path seen """
+
+        if len(self._stats) < max_size:
+            return
+        now = time.time()
+        for key, (_, expiration) in list(self._stats.items()):
+            if expiration <= now:
+                self._stats.pop(key, None)
+        # still full: drop the oldest entries
+        while len(self._stats) >= max_size:
+            self._stats.pop(next(iter(self._stats)), None)
+
+    def invalidate_stats(self, *paths):
+        """ Forget cached stats of paths and anything below them """
+
+        for path in paths:
+            if path != '/':
+                path = path.rstrip('/')
+            prefix = self.subtree_prefix(path)
+            for key in list(self._stats.keys()):
+                if key == path or key.startswith(prefix):
+                    self._stats.pop(key, None)
+
     def is_collection(self, path):
-        return self.rpc.collections.exists(path)
+        stat = self.stat(path)
+        return stat is not None and stat['type'] == 'collection'
 
     def is_dataobject(self, path):
-        try:
-            self.rpc.data_objects.get(path)
-            return True
-        except iexceptions.CollectionDoesNotExist:
-            return False
-        except iexceptions.DataObjectDoesNotExist:
-            return False
+        stat = self.stat(path)
+        return stat is not None and stat['type'] == 'dataobject'
 
     def get_dataobject(self, path):
         try:
@@ -63,69 +216,462 @@ class IrodsPythonClient():
         ):
             raise IrodsException("%s not found or no permissions" % path)
 
-    def list(self, path=None, recursive=False, detailed=False, acl=False):
-        """ List the files inside an iRODS path/collection """
+    def list(self, path=None, recursive=False, detailed=False, acl=False,
+             limit=None, offset=0):
+        """
+        List the files inside an iRODS path/collection
+
+        The listing is built on bulk GenQuery calls: one for collections,
+        one for data objects and (optionally) two for the whole subtree ACL,
+        instead of a catalog round-trip for each entry.
+        Collections come first, then data objects, both sorted by name:
+        use 'limit' and 'offset' to list huge collections incrementally.
+        """
+
+        path = self.get_listing_path(path)
+
+        collections = self.query_collections(
+            path, recursive=recursive, offset=offset, limit=limit)
+
+        dataobjects = []
+        if limit is None or len(collections) < limit:
+            objects_offset = 0
+            if len(collections) < 1 and offset > 0:
+                skipped = self.count_collections(path, recursive=recursive)
+                objects_offset = max(0, offset - skipped)
+
+            objects_limit = None
+            if limit is not None:
+                objects_limit = limit - len(collections)
+
+            dataobjects = self.query_dataobjects(
+                path, recursive=recursive,
+                offset=objects_offset, limit=objects_limit)
+
+        acls = {}
+        if acl:
+            acls = self.query_acls(path, recursive=recursive)
+
+        data = {}
+        rows = {}
+        for coll in collections:
+            row = self.collection_row(coll, detailed)
+            row["objects"] = {}
+            if acl:
+                row["acl"] = acls.get(coll['path'], [])
+                # TO FIX: how to retrieve inheritance?
+                row["acl_inheritance"] = "N/A"
+            rows[coll['path']] = row
+
+        for obj in dataobjects:
+            row = self.dataobject_row(obj, detailed)
+            if acl:
+                row["acl"] = acls.get(obj['path'], [])
+                row["acl_inheritance"] = "N/A"
+            rows[obj['path']] = row
+
+        # Nest the (recursive) results into their parents
+        for current_path, row in rows.items():
+            parent = self.get_collection_from_path(current_path)
+            if parent == path:
+                data[row["name"]] = row
+            elif parent in rows:
+                rows[parent]["objects"][row["name"]] = row
+            else:
+                # the parent was left out by paging
+                data[os.path.relpath(current_path, path)] = row
+
+        return data
+
+    def iterate(self, path=None, recursive=False, detailed=False,
+                cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Walk a collection listing without loading it all in memory.
+
+        Yields (row, cursor) tuples in the same stable order of list();
+        the opaque cursor can be given back to resume right after that row.
+        """
+
+        path = self.get_listing_path(path)
+        kind, offset = self.decode_cursor(cursor)
+        return self.iterate_rows(
+            path, recursive, detailed, kind, offset, batch_size)
+
+    def iterate_rows(self, path, recursive, detailed,
+                     kind, offset, batch_size):
+
+        if kind == self.CURSOR_COLLECTIONS:
+            query = self.collections_query(path, recursive)
+            start = offset
+            while True:
+                results = list(
+                    self.paged(query, offset, batch_size).get_results())
+                for result in results:
+                    offset += 1
+                    coll = self.collection_from_result(path, result)
+                    if coll is None:
+                        continue
+                    yield self.collection_row(coll, detailed), \
+                        self.encode_cursor(kind, offset)
+                if len(results) < batch_size:
+                    break
+
+            kind = self.CURSOR_DATAOBJECTS
+            if offset == start and start > 0:
+                # resuming from a global offset beyond the collections
+                offset = max(
+                    0, start - self.count_collections(path, recursive))
+            else:
+                offset = 0
+
+        # offsets count data objects, not replicas
+        queries = self.dataobjects_queries(path, recursive)
+        counts = {}
+        while True:
+            results = self.paged_queries(
+                queries, offset, batch_size, counts)
+            names = [
+                (result[Collection.name], result[DataObject.name])
+                for result in results
+            ]
+            # offsets count every row, also the ones filtered out
+            details = {
+                obj['path']: obj for obj in self.dataobjects_details([
+                    (coll, name) for coll, name in names
+                    if coll == path or self.in_subtree(path, coll)])
+            }
+            for coll, name in names:
+                offset += 1
+                obj = details.get(self.get_absolute_path(name, root=coll))
+                if obj is None:
+                    continue
+                yield self.dataobject_row(obj, detailed), \
+                    self.encode_cursor(kind, offset)
+            if len(results) < batch_size:
+                break
+
+    def get_page(self, path=None, currentpage=1, perpage=10,
+                 recursive=False, detailed=False):
+        """
+        One page of a listing, as requested with the
+        currentpage/perpage parameters (see EndpointResource.get_paging).
+
+        Returns the rows and the cursor of the next page (None if last).
+        """
+
+        offset = (max(currentpage, 1) - 1) * perpage
+        cursor = self.encode_cursor(self.CURSOR_COLLECTIONS, offset)
+        iterator = self.iterate(
+            path, recursive=recursive, detailed=detailed,
+            cursor=cursor, batch_size=perpage + 1)
+
+        rows = []
+        next_cursor = None
+        for row, next_cursor in iterator:
+            rows.append(row)
+            if len(rows) >= perpage:
+                break
+
+        # look ahead to know if anything is left
+        if next(iterator, None) is None:
+            next_cursor = None
+
+        return rows, next_cursor
+
+    def encode_cursor(self, kind, offset):
+        plain = "%s:%d" % (kind, offset)
+        return base64.urlsafe_b64encode(plain.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+
+        if cursor is None:
+            return self.CURSOR_COLLECTIONS, 0
+        try:
+            plain = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            kind, offset = plain.decode('ascii').split(':')
+            offset = int(offset)
+        except (ValueError, UnicodeError):
+            kind = offset = None
+
+        kinds = (self.CURSOR_COLLECTIONS, self.CURSOR_DATAOBJECTS)
+        if kind not in kinds or offset < 0:
+            raise IrodsException(
+                "Invalid listing cursor: %s" % cursor,
+                status_code=hcodes.HTTP_BAD_REQUEST)
+        return kind, offset
+
+    def get_listing_path(self, path):
 
         if path is None:
             path = self.get_user_home()
+        if path != '/':
+            path = path.rstrip('/')
 
-        if self.is_dataobject(path):
+        stat = self.stat(path)
+        if stat is None:
+            raise IrodsException("Collection not found: %s" % path)
+        if stat['type'] == 'dataobject':
             raise IrodsException("Cannot list an object, get it instead")
-        try:
-            data = {}
-            root = self.rpc.collections.get(path)
-
-            for coll in root.subcollections:
-
-                row = {}
-                key = coll.name
-                row["PID"] = None
-                row["name"] = coll.name
-                row["objects"] = {}
-                if recursive:
-                    row["objects"] = self.list(
-                        coll.path, recursive, detailed, acl)
-                row["path"] = coll.path
-                row["object_type"] = "collection"
-                if detailed:
-                    row["owner"] = "-"
-                if acl:
-                    acl = self.get_permissions(coll)
-                    row["acl"] = acl["ACL"]
-                    row["acl_inheritance"] = acl["inheritance"]
-
-                data[key] = row
-
-            for obj in root.data_objects:
-
-                row = {}
-                key = obj.name
-                row["name"] = obj.name
-                row["path"] = obj.path
-                row["object_type"] = "dataobject"
-                row["PID"] = None
-                row["checksum"] = None
-
-                if detailed:
-                    row["owner"] = obj.owner_name
-                    row["content_length"] = obj.size
-                    row["created"] = obj.create_time
-                    row["last_modified"] = obj.modify_time
-                if acl:
-                    acl = self.get_permissions(obj)
-                    row["acl"] = acl["ACL"]
-                    row["acl_inheritance"] = acl["inheritance"]
-
-                data[key] = row
+        return path
 
-            return data
-        except iexceptions.CollectionDoesNotExist as e:
-            raise IrodsException("Collection not found: %s" % path)
+    @staticmethod
+    def collection_row(coll, detailed=False):
+
+        row = {}
+        row["PID"] = None
+        row["name"] = os.path.basename(coll['path'])
+        row["path"] = coll['path']
+        row["object_type"] = "collection"
+        if detailed:
+            row["owner"] = coll['owner']
+        return row
+
+    @staticmethod
+    def dataobject_row(obj, detailed=False):
+
+        row = {}
+        row["name"] = obj['name']
+        row["path"] = obj['path']
+        row["object_type"] = "dataobject"
+        row["PID"] = None
+        row["checksum"] = None
+        if detailed:
+            row["owner"] = obj['owner']
+            row["content_length"] = obj['size']
+            row["created"] = obj['created']
+            row["last_modified"] = obj['last_modified']
+        return row
+
+    @staticmethod
+    def subtree_prefix(path):
+        if path.endswith('/'):
+            return path
+        return path + '/'
+
+    @classmethod
+    def in_subtree(cls, path, name):
+        """
+        Like() also takes '_' and '%' inside path names as wildcards,
+        e.g. /zone/a_b/% matches /zone/aXb/c: rows are filtered again
+        """
+        return name != path and name.startswith(cls.subtree_prefix(path))
+
+    @staticmethod
+    def paged(query, offset=0, limit=None):
+        if offset > 0:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def filter_children(self, query, path, recursive, column, parent_column):
+        """ Restrict a GenQuery to the children (or subtree) of a path """
+
+        if recursive:
+            return query.filter(
+                Like(column, self.subtree_prefix(path) + '%'))
+        return query.filter(parent_column == path)
+
+    def collections_query(self, path, recursive=False):
+
+        query = self.rpc.query(
+            Collection.name, Collection.owner_name,
+            Collection.create_time, Collection.modify_time)
+        query = self.filter_children(
+            query, path, recursive, Collection.name, Collection.parent_name)
+        return query.order_by(Collection.name)
+
+    @classmethod
+    def collection_from_result(cls, path, result):
+
+        if not cls.in_subtree(path, result[Collection.name]):
+            return None
+        return {
+            'path': result[Collection.name],
+            'owner': result[Collection.owner_name],
+            'created': result[Collection.create_time],
+            'last_modified': result[Collection.modify_time],
+        }
 
-        # replicas = []
-        # for line in lines:
-        #     replicas.append(re.split("\s+", line.strip()))
-        # return replicas
+    def query_collections(self, path, recursive=False, offset=0, limit=None):
+
+        query = self.paged(
+            self.collections_query(path, recursive), offset, limit)
+
+        collections = []
+        for result in query.get_results():
+            coll = self.collection_from_result(path, result)
+            if coll is not None:
+                collections.append(coll)
+        return collections
+
+    def count_collections(self, path, recursive=False):
+
+        query = self.rpc.query(Collection.name)
+        query = self.filter_children(
+            query, path, recursive, Collection.name, Collection.parent_name)
+
+        counter = 0
+        for result in query.get_results():
+            if self.in_subtree(path, result[Collection.name]):
+                counter += 1
+        return counter
+
+    def filter_dataobjects(self, query, path, recursive=False):
+        """
+        Restrict a GenQuery to the data objects inside path, as a list
+        of queries to be read one after the other: the objects directly
+        inside path, then (if recursive) the ones in its subtree.
+        Together they keep the order by collection and name.
+        Note: filter the subtree rows with in_subtree
+        """
+
+        queries = [query.filter(Collection.name == path)]
+        if recursive:
+            queries.append(query.filter(
+                Like(Collection.name, self.subtree_prefix(path) + '%')))
+        return queries
+
+    def dataobjects_queries(self, path, recursive=False):
+        """
+        Only names are selected: GenQuery rows are distinct, so there
+        is one row for each data object and not one for each replica,
+        and offsets/limits count objects
+        """
+
+        query = self.rpc.query(Collection.name, DataObject.name) \
+            .order_by(Collection.name).order_by(DataObject.name)
+        return self.filter_dataobjects(query, path, recursive)
+
+    @staticmethod
+    def count_results(query):
+        counter = 0
+        for _ in query.get_results():
+            counter += 1
+        return counter
+
+    def paged_queries(self, queries, offset=0, limit=None, counts=None):
+        """
+        Rows from offset to offset + limit, across a list of queries.
+        'counts' keeps the sizes of the skipped queries between calls.
+        """
+
+        if counts is None:
+            counts = {}
+
+        results = []
+        for index, query in enumerate(queries):
+            if limit is not None and len(results) >= limit:
+                break
+            if offset > 0:
+                # the whole query may be skipped
+                counter = counts.get(index)
+                if counter is None:
+                    counter = self.count_results(query)
+                    counts[index] = counter
+                if offset >= counter:
+                    offset -= counter
+                    continue
+            remaining = None
+            if limit is not None:
+                remaining = limit - len(results)
+            results.extend(
+                self.paged(query, offset, remaining).get_results())
+            offset = 0
+        return results
+
+    def dataobjects_details(self, names):
+        """ Details of (collection, name) pairs, with one query """
+
+        if len(names) < 1:
+            return []
+
+        collections = sorted(set(coll for coll, _ in names))
+        objects = sorted(set(name for _, name in names))
+        query = self.rpc.query(
+            Collection.name, DataObject.name, DataObject.size,
+            DataObject.owner_name,
+            DataObject.create_time, DataObject.modify_time
+        ).filter(In(Collection.name, collections)) \
+         .filter(In(DataObject.name, objects))
+
+        details = {}
+        for result in query.get_results():
+            key = (result[Collection.name], result[DataObject.name])
+            # one row for each replica: the first one is enough
+            if key not in details:
+                details[key] = result
+
+        dataobjects = []
+        for coll, name in names:
+            result = details.get((coll, name))
+            if result is None:
+                # removed in the meantime
+                continue
+            dataobjects.append({
+                'path': self.get_absolute_path(name, root=coll),
+                'name': name,
+                'owner': result[DataObject.owner_name],
+                'size': result[DataObject.size],
+                'created': result[DataObject.create_time],
+                'last_modified': result[DataObject.modify_time],
+            })
+        return dataobjects
+
+    def query_dataobjects(self, path, recursive=False, offset=0, limit=None):
+
+        results = self.paged_queries(
+            self.dataobjects_queries(path, recursive), offset, limit)
+        names = [
+            (result[Collection.name], result[DataObject.name])
+            for result in results
+            if result[Collection.name] == path or
+            self.in_subtree(path, result[Collection.name])
+        ]
+        return self.dataobjects_details(names)
+
+    def query_acls(self, path, recursive=False):
+        """ ACLs of every collection and data object below path """
+
+        acls = {}
+
+        query = self.rpc.query(
+            Collection.name,
+            CollectionUser.name, CollectionUser.zone, CollectionAccess.name)
+        query = self.filter_children(
+            query, path, recursive, Collection.name, Collection.parent_name)
+        for result in query.get_results():
+            if recursive and \
+               not self.in_subtree(path, result[Collection.name]):
+                continue
+            acls.setdefault(result[Collection.name], []).append([
+                result[CollectionUser.name],
+                result[CollectionUser.zone],
+                result[CollectionAccess.name],
+            ])
+
+        query = self.rpc.query(
+            Collection.name, DataObject.name,
+            User.name, User.zone, DataAccess.name)
+        results = []
+        for current_query in self.filter_dataobjects(query, path, recursive):
+            results.extend(current_query.get_results())
+        for result in results:
+            if result[Collection.name] != path and \
+               not self.in_subtree(path, result[Collection.name]):
+                continue
+            obj_path = self.get_absolute_path(
+                result[DataObject.name], root=result[Collection.name])
+            entry = [
+                result[User.name],
+                result[User.zone],
+                result[DataAccess.name],
+            ]
+            # one row for each replica
+            if entry not in acls.setdefault(obj_path, []):
+                acls[obj_path].append(entry)
+
+        return acls
 
     def create_empty(self, path, directory=False, ignore_existing=False):
 
@@ -136,6 +682,7 @@ class IrodsPythonClient():
 
     def create_directory(self, path, ignore_existing=False):
 
+        self.invalidate_stats(path)
         try:
 
             ret = self.rpc.collections.create(path)
@@ -163,6 +710,7 @@ class IrodsPythonClient():
 
     def create_file(self, path, ignore_existing=False):
 
+        self.invalidate_stats(path)
         try:
 
             ret = self.rpc.data_objects.create(path)
@@ -191,32 +739,47 @@ class IrodsPythonClient():
         if self.is_collection(sourcepath):
             raise IrodsException("Copy directory not supported")
 
-        if compute_checksum:
-            raise IrodsException(
-                "Compute_checksum not supported in copy")
-
-        if compute_and_verify_checksum:
-            raise IrodsException(
-                "Compute_and_verify_checksum not supported in copy")
-
         if sourcepath == destpath:
             raise IrodsException(
                 "Source and destination path are the same")
+
+        hashers = None
+        if compute_checksum or compute_and_verify_checksum:
+            hashers = self.get_hashers()
         try:
             log.verbose("Copy %s into %s" % (sourcepath, destpath))
             source = self.rpc.data_objects.get(sourcepath)
             self.create_empty(
                 destpath, directory=False, ignore_existing=force)
             target = self.rpc.data_objects.get(destpath)
-            with source.open('r+') as f:
+            with source.open('r') as f:
                 with target.open('w') as t:
-                    for line in f:
-                        # if t.writable():
-                        t.write(line)
+                    self.copy_in_chunks(f, t, hashers=hashers)
+
+            try:
+                if compute_and_verify_checksum:
+                    # the data read must match the checksum of the source
+                    registered = self.stat(sourcepath)['checksum']
+                    if registered and \
+                       not self.checksum_matches(registered, hashers):
+                        raise IrodsException(
+                            "Checksum mismatch on source %s" % sourcepath,
+                            status_code=hcodes.HTTP_SERVER_ERROR)
+
+                if hashers is not None:
+                    return self.register_checksum(destpath, hashers)
+            except IrodsException:
+                # as in save: a corrupted copy is not left in place
+                self.invalidate_stats(destpath)
+                if self.is_dataobject(destpath):
+                    self.remove(destpath, force=True)
+                raise
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Data object not found: %s" % sourcepath)
         except iexceptions.CollectionDoesNotExist:
             raise IrodsException("Collection not found: %s" % sourcepath)
+        finally:
+            self.invalidate_stats(destpath)
 
     def move(self, src_path, dest_path):
 
@@ -239,6 +802,8 @@ class IrodsPythonClient():
         except iexceptions.CAT_NAME_EXISTS_AS_DATAOBJ:
             # raised from both collection and data objects?
             raise IrodsException("Destination path already exists")
+        finally:
+            self.invalidate_stats(src_path, dest_path)
 
     def remove(self, path, recursive=False, force=False, resource=None):
         try:
@@ -254,6 +819,8 @@ class IrodsPythonClient():
                 "Cannot delete an empty directory without recursive flag")
         except iexceptions.CAT_NO_ROWS_FOUND:
             raise IrodsException("Irods delete error: path not found")
+        finally:
+            self.invalidate_stats(path)
 
         # TO FIX: remove resource
         # if resource is not None:
@@ -280,6 +847,8 @@ class IrodsPythonClient():
                 handle.close()
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Cannot write to file: not found")
+        finally:
+            self.invalidate_stats(path)
 
     def get_file_content(self, path):
         try:
@@ -314,6 +883,93 @@ class IrodsPythonClient():
             raise IrodsException("Cannot read file: not found")
         return False
 
+    def read_in_streaming(self, absolute_path,
+                          chunk_size=DEFAULT_CHUNK_SIZE,
+                          offset=0, length=None):
+        """
+        Read a data object as a generator of binary chunks,
+        without copying it on the local file system.
+
+        Note: the object is resolved here, so that a missing path
+        raises before any streaming starts.
+        """
+
+        obj = self.get_dataobject(absolute_path)
+        return self.read_chunks(obj, chunk_size, offset, length)
+
+    @staticmethod
+    def read_chunks(obj, chunk_size=DEFAULT_CHUNK_SIZE,
+                    offset=0, length=None):
+
+        with obj.open('r') as handle:
+
+            if offset > 0:
+                handle.seek(offset)
+
+            remaining = length
+            while remaining is None or remaining > 0:
+
+                size = chunk_size
+                if remaining is not None:
+                    size = min(chunk_size, remaining)
+
+                data = handle.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+    def stream_download(self, absolute_path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Build a streaming response straight from the iRODS handle.
+
+        Byte ranges from the current request are honoured by seeking
+        into the data object; the size is taken from the catalog.
+        """
+
+        from flask import request, Response
+
+        obj = self.get_dataobject(absolute_path)
+        size = obj.size
+
+        mimetype, _ = mimetypes.guess_type(obj.name)
+        if mimetype is None:
+            mimetype = 'application/octet-stream'
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': content_disposition(obj.name),
+        }
+        code = hcodes.HTTP_OK_BASIC
+        offset = 0
+        length = size
+
+        satisfiable, current_range = requested_range(request.range, size)
+        if not satisfiable:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(
+                status=hcodes.HTTP_BAD_RANGE_NOT_SATISFIABLE,
+                headers=headers, mimetype=mimetype)
+
+        if current_range is not None:
+            start, stop = current_range
+            offset = start
+            length = stop - start
+            code = hcodes.HTTP_PARTIAL_CONTENT
+            headers['Content-Range'] = \
+                request.range.to_content_range_header(size)
+
+        headers['Content-Length'] = str(length)
+        log.verbose(
+            "Streaming %s bytes of %s from offset %s"
+            % (length, absolute_path, offset))
+
+        return Response(
+            self.read_chunks(obj, chunk_size, offset, length),
+            status=code, headers=headers, mimetype=mimetype,
+            direct_passthrough=True)
+
     def save(self, path, destination, force=False, resource=None):
 
         # TO FIX: resource is not used!
@@ -329,11 +985,12 @@ class IrodsPythonClient():
 
                 try:
                     with obj.open('w') as target:
-                        for line in handle:
-                            target.write(line)
+                        self.copy_in_chunks(handle, target)
                 except BaseException as e:
                     self.remove(destination, force=True)
                     raise e
+                finally:
+                    self.invalidate_stats(destination)
 
             return True
 
@@ -344,6 +1001,146 @@ class IrodsPythonClient():
 
         return False
 
+    def write_in_streaming(self, destination, stream, force=False,
+                           chunk_size=DEFAULT_CHUNK_SIZE,
+                           compute_checksum=False):
+        """
+        Write a binary stream (e.g. flask request.stream) straight into
+        a data object, without spooling it on the local file system.
+
+        Returns the checksum computed while writing, in iRODS format;
+        with compute_checksum the server registers its own checksum,
+        which has to match the one computed here (or the data object
+        is removed).
+        """
+
+        try:
+            self.create_empty(
+                destination, directory=False, ignore_existing=force)
+            obj = self.rpc.data_objects.get(destination)
+        except iexceptions.CollectionDoesNotExist:
+            raise IrodsException("Cannot write to file: path not found")
+
+        # md5 too only to verify what the server registers
+        hashers = self.get_hashers(verify=compute_checksum)
+        try:
+            with obj.open('w') as target:
+                self.copy_in_chunks(stream, target, chunk_size, hashers)
+            if compute_checksum:
+                self.register_checksum(destination, hashers)
+        except BaseException as e:
+            self.remove(destination, force=True)
+            raise e
+        finally:
+            self.invalidate_stats(destination)
+
+        checksum = self.format_checksum(hashers[0])
+        log.debug("Streamed %s (%s)" % (destination, checksum))
+        return checksum
+
+    @staticmethod
+    def copy_in_chunks(source, target,
+                       chunk_size=DEFAULT_CHUNK_SIZE, hashers=None):
+        """ Copy between two file-like objects with bounded memory """
+
+        if hashers is None:
+            hashers = []
+
+        written = 0
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            for hasher in hashers:
+                hasher.update(chunk)
+            target.write(chunk)
+            written += len(chunk)
+        return written
+
+    @staticmethod
+    def get_hashers(verify=True):
+        """
+        The server may register sha256 or md5 checksums
+        (depending on its default hash scheme): to verify them compute
+        both while streaming, to avoid reading the data a second time.
+        The first one is always sha256.
+        """
+        if not verify:
+            return [hashlib.sha256()]
+        return [hashlib.sha256(), hashlib.md5()]
+
+    @classmethod
+    def checksum_matches(cls, checksum, hashers):
+        for hasher in hashers:
+            if cls.format_checksum(hasher) == checksum:
+                return True
+        return False
+
+    def register_checksum(self, path, hashers=None):
+        """
+        Ask the server to compute and register the checksum of path;
+        if hashers are given, verify it against the local computation.
+        """
+
+        try:
+            checksum = self.rpc.data_objects.chksum(path)
+        except iexceptions.DataObjectDoesNotExist:
+            raise IrodsException("Cannot compute checksum: not found")
+        finally:
+            self.invalidate_stats(path)
+
+        if hashers is not None and not self.checksum_matches(
+                checksum, hashers):
+            raise IrodsException(
+                "Checksum mismatch for %s: registered %s"
+                % (path, checksum),
+                status_code=hcodes.HTTP_SERVER_ERROR)
+
+        log.verbose("Checksum of %s: %s" % (path, checksum))
+        return checksum
+
+    def verify_checksum(self, path):
+        """
+        Ask the server to verify that the registered checksum
+        still matches the data stored for path.
+        """
+
+        options = {kw.VERIFY_CHKSUM_KW: ''}
+        try:
+            self.rpc.data_objects.chksum(path, **options)
+        except iexceptions.USER_CHKSUM_MISMATCH:
+            return False
+        return True
+
+    def verify_checksums(self, paths, workers=DEFAULT_CHECKSUM_WORKERS):
+        """
+        Verify many data objects at once, fanning out the checksum
+        requests on the pooled connections of the current session.
+
+        Returns a dictionary path: True/False, or the error message
+        when the verification could not be executed.
+        """
+
+        def verify(path):
+            try:
+                return self.verify_checksum(path)
+            except BaseException as e:
+                log.warning("Cannot verify %s: %s" % (path, e))
+                return str(e)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(verify, paths)
+            return dict(zip(paths, results))
+
+    @staticmethod
+    def format_checksum(hasher):
+        """ Same representation used by iRODS for registered checksums """
+
+        if hasher.name == 'sha256':
+            digest = base64.b64encode(hasher.digest()).decode('ascii')
+            return "sha2:%s" % digest
+        return hasher.hexdigest()
+
     ############################################
     # ############ ACL Management ##############
     ############################################
@@ -352,12 +1149,13 @@ class IrodsPythonClient():
 
         if type(coll_or_obj) is str:
 
-            if self.is_collection(coll_or_obj):
-                coll_or_obj = self.rpc.collections.get(coll_or_obj)
-            elif self.is_dataobject(coll_or_obj):
+            stat = self.stat(coll_or_obj)
+            if stat is None:
+                coll_or_obj = None
+            elif stat['type'] == 'collection':
                 coll_or_obj = self.rpc.collections.get(coll_or_obj)
             else:
-                coll_or_obj = None
+                coll_or_obj = self.rpc.data_objects.get(coll_or_obj)
 
         if coll_or_obj is None:
             raise IrodsException("Cannot get permission of a null object")
@@ -399,7 +1197,7 @@ class IrodsPythonClient():
         except iexceptions.CAT_INVALID_USER:
             raise IrodsException("Cannot set ACL: user or group not found")
         except iexceptions.CAT_INVALID_ARGUMENT:
-            if not self.is_collection(path) and not self.is_dataobject(path):
+            if self.stat(path) is None:
                 raise IrodsException("Cannot set ACL: path not found")
             else:
                 raise IrodsException("Cannot set ACL")
@@ -430,6 +1228,64 @@ class IrodsPythonClient():
                     "Cannot set inheritance: collection not found")
         return False
 
+    def apply_recursively(self, path, action, only_collections=False,
+                          cursor=None, batch_size=DEFAULT_BATCH_SIZE,
+                          progress=None):
+        """
+        Apply 'action' (a function receiving a path) to a whole tree,
+        walking it in batches with bulk GenQuery calls.
+
+        After each batch 'progress' is called with the number of
+        entries done so far and a checkpoint: give it back as 'cursor'
+        to resume the walk, e.g. after a failure.
+        """
+
+        done = 0
+        if cursor is None:
+            action(path)
+            done += 1
+
+        checkpoint = cursor
+        iterator = self.iterate(
+            path, recursive=True, cursor=cursor, batch_size=batch_size)
+        for row, checkpoint in iterator:
+
+            # collections always come before data objects
+            if only_collections and row['object_type'] != 'collection':
+                break
+
+            action(row['path'])
+            done += 1
+            if progress is not None and done % batch_size == 0:
+                progress(done, checkpoint)
+
+        if progress is not None:
+            progress(done, checkpoint)
+        log.debug("Recursive operation applied to %s paths" % done)
+        return done
+
+    def set_permissions_in_batches(self, path, permission, userOrGroup,
+                                   zone='', **kwargs):
+        """
+        Same of set_permissions with recursive=True, but applied
+        entry by entry: see apply_recursively for the arguments.
+        """
+
+        def action(current_path):
+            self.set_permissions(
+                current_path, permission, userOrGroup, zone=zone)
+
+        return self.apply_recursively(path, action, **kwargs)
+
+    def set_inheritance_in_batches(self, path, inheritance=True, **kwargs):
+        """ Inheritance only applies to collections """
+
+        def action(current_path):
+            self.set_inheritance(current_path, inheritance=inheritance)
+
+        return self.apply_recursively(
+            path, action, only_collections=True, **kwargs)
+
     def get_user_home(self, user=None):
 
         zone = self.get_current_zone(prepend_slash=True)
@@ -467,36 +1323,56 @@ class IrodsPythonClient():
             zone = '/' + zone
         return zone
 
-    @lru_cache(maxsize=4)
     def get_user_info(self, username=None):
 
         if username is None:
             username = self.get_current_user()
-        try:
-            user = self.rpc.users.get(username)
-            data = {}
-            data["id"] = user.id
-            data["name"] = user.name
-            data["type"] = user.type
-            data["zone"] = user.zone
-            # data["info"] = ""
-            # data["comment"] = ""
-            # data["create time"] = ""
-            # data["modify time"] = ""
-            data["account"] = user.manager.sess.pool.account.__dict__
-
-            results = self.rpc.query(UserGroup.name).filter(
-                User.name == user.name).get_results()
-            groups = []
-            for obj in results:
-                for _, grp in obj.items():
-                    groups.append(grp)
-
-            data['groups'] = groups
-            return data
-        except iexceptions.UserDoesNotExist:
+        zone = self.get_current_zone()
+
+        data = users_cache.get(zone, username)
+        if data is users_cache.MISSING:
+            data = self.query_user_info(username, zone)
+            users_cache.set(
+                zone, username, data, ttl=self.get_users_cache_ttl())
+
+        if data is None:
             return None
 
+        # never share cached objects (or sessions) with the caller
+        data = dict(data)
+        data['groups'] = list(data['groups'])
+        data["account"] = self.rpc.pool.account.__dict__
+        return data
+
+    def query_user_info(self, username, zone):
+        """ User details and groups with one joined GenQuery """
+
+        results = self.rpc.query(
+            User.id, User.name, User.type, User.zone, UserGroup.name
+        ).filter(User.name == username) \
+         .filter(User.zone == zone).get_results()
+
+        data = None
+        for result in results:
+            if data is None:
+                data = {}
+                data["id"] = result[User.id]
+                data["name"] = result[User.name]
+                data["type"] = result[User.type]
+                data["zone"] = result[User.zone]
+                # data["info"] = ""
+                # data["comment"] = ""
+                # data["create time"] = ""
+                # data["modify time"] = ""
+                data['groups'] = []
+            data['groups'].append(result[UserGroup.name])
+
+        return data
+
+    def get_users_cache_ttl(self):
+        return int(self.variables.get(
+            'users_cache_ttl', DEFAULT_USERS_CACHE_TTL))
+
     def user_has_group(self, username, groupname):
         info = self.get_user_info(username)
         if info is None:
@@ -558,6 +1434,120 @@ class IrodsPythonClient():
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Cannot set metadata, object not found")
 
+    def query_metadata(self, paths):
+        """
+        All the AVUs of many data objects: a single GenQuery
+        for each collection involved, instead of one call per object.
+        """
+
+        by_collection = {}
+        for path in paths:
+            collection = self.get_collection_from_path(path)
+            by_collection.setdefault(collection, set()).add(
+                os.path.basename(path))
+
+        avus = {path: [] for path in paths}
+        for collection, names in by_collection.items():
+
+            query = self.rpc.query(
+                Collection.name, DataObject.name,
+                DataObjectMeta.name, DataObjectMeta.value,
+                DataObjectMeta.units
+            ).filter(Collection.name == collection) \
+             .filter(In(DataObject.name, list(names)))
+
+            for result in query.get_results():
+                path = self.get_absolute_path(
+                    result[DataObject.name], root=collection)
+                avu = (
+                    result[DataObjectMeta.name],
+                    result[DataObjectMeta.value],
+                    result[DataObjectMeta.units],
+                )
+                # one row for each replica
+                if avu not in avus[path]:
+                    avus[path].append(avu)
+
+        return avus
+
+    def get_metadata_bulk(self, paths):
+        """ Same output of get_metadata, for many paths at once """
+
+        metadata = {}
+        for path, avus in self.query_metadata(paths).items():
+            data = {}
+            units = {}
+            for name, value, unit in avus:
+                data[name] = value
+                units[name] = unit
+            metadata[path] = (data, units)
+
+        return metadata
+
+    def set_metadata_bulk(self, metadata, dry_run=False):
+        """
+        Set many AVUs on many data objects.
+
+        'metadata' maps each path to a dictionary of name: value
+        (or name: (value, units)); an existing AVU with the same name
+        is replaced. Each object is updated with a single atomic request.
+
+        Returns the differences, for each path, as lists of
+        (name, value, units) AVUs to 'add' and to 'remove';
+        with dry_run nothing is applied.
+        """
+
+        current = self.query_metadata(list(metadata.keys()))
+
+        diff = {}
+        for path, meta in metadata.items():
+            to_add = []
+            to_remove = []
+            for name, value in meta.items():
+
+                units = None
+                if isinstance(value, (tuple, list)):
+                    value, units = value
+                # GenQuery returns '' for AVUs without units
+                avu = (name, str(value), units or '')
+
+                existing = [
+                    (n, v, u or '') for n, v, u in current[path] if n == name]
+                if avu in existing:
+                    continue
+                to_remove.extend(existing)
+                to_add.append(avu)
+
+            if len(to_add) > 0 or len(to_remove) > 0:
+                diff[path] = {'add': to_add, 'remove': to_remove}
+
+        if dry_run:
+            return diff
+
+        for path, changes in diff.items():
+            operations = []
+            for name, value, units in changes['remove']:
+                operations.append(AVUOperation(
+                    operation='remove',
+                    avu=iRODSMeta(name, value, units or None)))
+            for name, value, units in changes['add']:
+                operations.append(AVUOperation(
+                    operation='add',
+                    avu=iRODSMeta(name, value, units or None)))
+            try:
+                self.rpc.metadata.apply_atomic_operations(
+                    DataObject, path, *operations)
+            except (
+                iexceptions.DataObjectDoesNotExist,
+                iexceptions.CAT_NO_ROWS_FOUND
+            ):
+                raise IrodsException(
+                    "Cannot set metadata, object not found: %s" % path)
+            log.verbose("Applied %s metadata operations on %s"
+                        % (len(operations), path))
+
+        return diff
+
     def get_user_from_dn(self, dn):
         results = self.rpc.query(User.name, UserAuth.user_dn) \
             .filter(UserAuth.user_dn == dn).first()
@@ -582,6 +1572,8 @@ class IrodsPythonClient():
         except iexceptions.CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
             log.warning("User %s already exists in iRODS" % user)
             return False
+        finally:
+            users_cache.invalidate(self.get_current_zone(), user)
 
         return True
 
@@ -613,6 +1605,7 @@ class IrodsPythonClient():
 
         # addAuth / rmAuth
         self.rpc.users.modify(user, 'addAuth', dn)
+        users_cache.invalidate(self.get_current_zone(), user)
         # self.rpc.users.modify(user, 'addAuth', dn, user_zone=zone)
 
 
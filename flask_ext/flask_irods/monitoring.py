@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of every call made through an iRODS session.
+
+The session managers (collections, data objects, permissions, users,
+metadata) and the GenQuery executions are wrapped, so that counters
+and latencies for each operation feed the 'irods' metrics;
+calls over the threshold end up in the slow calls log.
+"""
+
+import time
+from functools import wraps
+from irods.query import Query
+from rapydo.utils.metrics import get_metrics
+
+metrics = get_metrics('irods')
+
+
+class InstrumentedSession(object):
+
+    MANAGERS = (
+        'collections', 'data_objects', 'permissions', 'users', 'metadata')
+
+    def __init__(self, session, threshold):
+        self._session = session
+        self._threshold = threshold
+
+    def __getattr__(self, attr):
+
+        value = getattr(self._session, attr)
+
+        if attr in self.MANAGERS:
+            return InstrumentedManager(value, attr, self)
+
+        if attr == 'query':
+            @wraps(value)
+            def query(*args, **kwargs):
+                return InstrumentedQuery(value(*args, **kwargs), self)
+            return query
+
+        return value
+
+    def observe(self, operation, elapsed, failed=False, path=None):
+        metrics.observe(
+            operation, elapsed, failed=failed, threshold=self._threshold,
+            path=path, user=self._session.username)
+
+    def timed(self, operation, function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+
+            path = None
+            if len(args) > 0 and isinstance(args[0], str):
+                path = args[0]
+
+            start = time.time()
+            failed = False
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self.observe(operation, time.time() - start, failed, path)
+
+        return wrapper
+
+    def timed_generator(self, operation, function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+
+            # only the time spent inside the generator is accounted
+            elapsed = 0.0
+            failed = False
+            generator = function(*args, **kwargs)
+            try:
+                while True:
+                    start = time.time()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        break
+                    finally:
+                        elapsed += time.time() - start
+                    yield item
+            except GeneratorExit:
+                # the caller stopped iterating: not a failure
+                raise
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                self.observe(operation, elapsed, failed)
+
+        return wrapper
+
+
+class InstrumentedManager(object):
+
+    def __init__(self, manager, name, session):
+        self._manager = manager
+        self._name = name
+        self._session = session
+
+    def __getattr__(self, attr):
+
+        value = getattr(self._manager, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        operation = "%s.%s" % (self._name, attr)
+        return self._session.timed(operation, value)
+
+
+class InstrumentedQuery(object):
+
+    EXECUTIONS = ('execute', 'all', 'one', 'first')
+    GENERATORS = ('get_results', 'get_batches')
+
+    def __init__(self, query, session):
+        self._query = query
+        self._session = session
+
+    def __getattr__(self, attr):
+
+        value = getattr(self._query, attr)
+
+        if attr in self.EXECUTIONS:
+            return self._session.timed("query.%s" % attr, value)
+
+        if attr in self.GENERATORS:
+            return self._session.timed_generator("query.%s" % attr, value)
+
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        # keep chained calls (filter, order_by, limit...) instrumented
+        @wraps(value)
+        def chained(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if isinstance(result, Query):
+                return InstrumentedQuery(result, self._session)
+            return result
+
+        return chained
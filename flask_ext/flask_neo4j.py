@@ -2,35 +2,250 @@
 
 """ Neo4j GraphDB flask connector """
 
+import os
+import re
+import time
 import socket
+import hashlib
+import threading
+from functools import lru_cache
+from flask import g, has_app_context
 import neo4j
 from neomodel import db, config
 from flask_ext import BaseExtension, get_logger
 from rapydo.utils.logs import re_obscure_pattern
+from rapydo.utils.metrics import get_metrics, DEFAULT_SLOW_THRESHOLD
 
 log = get_logger(__name__)
 
+metrics = get_metrics('neo4j')
+
+STATEMENTS_CACHE_SIZE = 1024
+READ_ACCESS = 'READ'
+# where the sessions of a request are kept, inside flask.g
+SESSIONS_ATTRIBUTE = '_neo4j_sessions'
+# the pool options below need neo4j-driver 1.5+
+POOL_OPTIONS_VERSION = (1, 5)
+
+# quoted strings and identifiers are kept as they are,
+# comments and whitespace are reduced to a space
+TOKENS = re.compile(
+    r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)"""
+    r"""|(?:\s|//[^\n]*|/\*.*?\*/)+""", re.DOTALL)
+LITERALS = re.compile(
+    r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?\b""")
+
+# Schema descriptions, as listed by db.indexes() and db.constraints()
+INDEX_DESCRIPTION = re.compile(r"INDEX ON :`?(\w+)`?\(`?(\w+)`?\)")
+CONSTRAINT_DESCRIPTION = re.compile(
+    r"CONSTRAINT ON \( `?\w+`?:`?(\w+)`? \) "
+    r"ASSERT `?\w+`?\.`?(\w+)`? IS UNIQUE")
+
+
+@lru_cache(maxsize=STATEMENTS_CACHE_SIZE)
+def prepare_statement(query):
+    """
+    The text sent to neo4j (the query as given, only stripped)
+    and a fingerprint of the statement without comments, whitespace
+    and literals, to group the timings of queries still
+    interpolating values.
+    """
+
+    text = query.strip()
+    normalized = TOKENS.sub(
+        lambda m: m.group(1) if m.group(1) else ' ', text).strip()
+    masked = LITERALS.sub('?', normalized)
+    fingerprint = hashlib.sha1(masked.encode()).hexdigest()[:12]
+    return text, fingerprint, masked
+
+
+# One driver (and pool) for the whole process: neomodel db is
+# thread local, so it is installed on the db of every thread using it
+_shared_driver = {'driver': None, 'url': None, 'pid': None}
+_shared_driver_lock = threading.Lock()
+
+
+def install_driver():
+    """ The driver of the process for the neomodel db of this thread """
+
+    driver = _shared_driver['driver']
+    if driver is None or _shared_driver['pid'] != os.getpid():
+        return
+    if getattr(db, 'driver', None) is not driver:
+        db.driver = driver
+        db.url = _shared_driver['url']
+        db._pid = os.getpid()
+        db._active_transaction = None
+
+
+def driver_version():
+    try:
+        from neo4j.meta import version
+    except ImportError:
+        return None
+    return tuple(int(n) for n in re.findall(r'\d+', version)[:2])
+
 
 class NeomodelClient():
 
-    def __init__(self, db):
+    def __init__(self, db, threshold=DEFAULT_SLOW_THRESHOLD):
         self.db = db
+        self.threshold = threshold
+        self._local = threading.local()
+
+    def get_sessions(self):
+        """
+        Sessions are not thread safe, while this client is shared:
+        they belong to the current request (app context),
+        or to the current thread outside of requests.
+        """
+
+        if has_app_context():
+            sessions = getattr(g, SESSIONS_ATTRIBUTE, None)
+            if sessions is None:
+                sessions = {}
+                setattr(g, SESSIONS_ATTRIBUTE, sessions)
+            return sessions
+
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = {}
+            self._local.sessions = sessions
+        return sessions
+
+    def get_session(self, access_mode=None):
+        """ One session (for each access mode) during the whole request """
+
+        sessions = self.get_sessions()
+        session = sessions.get(access_mode)
+        if session is None:
+            install_driver()
+            if access_mode is None:
+                session = self.db.driver.session()
+            else:
+                session = self.db.driver.session(access_mode=access_mode)
+            sessions[access_mode] = session
+            update_pool_metrics(self.db.driver)
+        return session
+
+    def close(self):
+        close_sessions(self.get_sessions())
+        update_pool_metrics(self.db.driver)
+
+    def cypher_query(self, query, params=None, read_only=False):
+        """
+        Same as neomodel db.cypher_query, returning (results, meta), but
+        on the session of the request (or the current transaction),
+        timed in the metrics. Read only queries may be routed to a
+        follower in a cluster, when not part of the current transaction.
+        """
+
+        if params is None:
+            params = {}
+        text, fingerprint, masked = prepare_statement(query)
+
+        start = time.time()
+        failed = False
+        try:
+            if getattr(db, '_active_transaction', None) is not None:
+                return db.cypher_query(text, params)
+            access_mode = READ_ACCESS if read_only else None
+            return self.run_query(
+                self.get_session(access_mode), text, params)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.observe(
+                "cypher.%s" % fingerprint, time.time() - start,
+                failed=failed, threshold=self.threshold, query=masked)
+
+    def cypher(self, query, params=None, read_only=False):
+        """
+        Execute normal neo4j queries, with values bound as parameters:
+            cypher("MATCH (u:User) WHERE u.email = $email RETURN u",
+                   {'email': email})
+        """
 
-    def cypher(self, query):
-        """ Execute normal neo4j queries """
-        from neomodel import db
         try:
-            results, meta = db.cypher_query(query)
+            results, meta = self.cypher_query(query, params, read_only)
+        except transient_graph_exceptions():
+            # unchanged, to be recognized by graph_retry_transactions
+            raise
         except Exception as e:
             raise Exception(
                 "Failed to execute Cypher Query: %s\n%s" % (query, str(e)))
-            return False
         # log.debug("Graph query.\nResults: %s\nMeta: %s" % (results, meta))
         return results
 
+    @staticmethod
+    def run_query(session, text, params):
+        response = session.run(text, params)
+        results = [list(record.values()) for record in response]
+        meta = response.keys()
+        return results, meta
+
+
+def transient_graph_exceptions():
+    """ Errors worth a retry: deadlocks, leader switches, lost servers """
+
+    exceptions = []
+    for module_name, names in (
+            ('neo4j.exceptions',
+             ('TransientError', 'ServiceUnavailable', 'SessionExpired')),
+            ('neo4j.bolt.connection', ('ServiceUnavailable', )),
+            ('neo4j.v1.api', ('SessionExpired', ))):
+        try:
+            module = __import__(module_name, fromlist=list(names))
+        except ImportError:
+            continue
+        for name in names:
+            exception = getattr(module, name, None)
+            if exception is not None and exception not in exceptions:
+                exceptions.append(exception)
+    return tuple(exceptions)
+
+
+def close_sessions(sessions):
+    for session in sessions.values():
+        try:
+            session.close()
+        except Exception as e:
+            log.warning("Failed to close neo4j session: %s" % e)
+    sessions.clear()
+
+
+def update_pool_metrics(driver):
+    """ Connections of the bolt driver pool, as gauges """
+
+    pool = getattr(driver, '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if connections is None:
+        return
+
+    size = 0
+    in_use = 0
+    for address_connections in list(connections.values()):
+        for connection in list(address_connections):
+            size += 1
+            if getattr(connection, 'in_use', False):
+                in_use += 1
+
+    max_size = config.MAX_POOL_SIZE
+    metrics.set_gauge('pool.size', size)
+    metrics.set_gauge('pool.in_use', in_use)
+    metrics.set_gauge('pool.max_size', max_size)
+    if max_size:
+        metrics.set_gauge('pool.saturation', in_use / max_size)
+
 
 class NeoModel(BaseExtension):
 
+    def init_app(self, app):
+        super(NeoModel, self).init_app(app)
+        # neomodel queries of any request thread use the shared driver
+        app.before_request(install_driver)
+
     def set_connection_exception(self):
         return (
             socket.gaierror,
@@ -59,10 +274,139 @@ class NeoModel(BaseExtension):
         # Ensure all DateTimes are provided with a timezone
         # before being serialised to UTC epoch
         config.FORCE_TIMEZONE = True  # default False
-        db.url = self.uri
-        db.set_connection(self.uri)
 
-        client = NeomodelClient(db)
+        # The driver (and its pool) is shared by all requests
+        with _shared_driver_lock:
+            if _shared_driver['driver'] is None or \
+               _shared_driver['url'] != self.uri or \
+               _shared_driver['pid'] != os.getpid():
+                self.set_driver(variables)
+        install_driver()
+
+        client = NeomodelClient(
+            db, float(variables.get(
+                'slow_call_threshold', DEFAULT_SLOW_THRESHOLD)))
         return client
 
         # return db
+
+    def set_driver(self, variables):
+        """
+        Same as neomodel db.set_connection, with the pool configured from:
+        GRAPHDB_MAX_POOL_SIZE, GRAPHDB_MAX_CONNECTION_LIFETIME (seconds)
+        and GRAPHDB_CONNECTION_ACQUISITION_TIMEOUT (seconds).
+
+        Options use the names of neo4j-driver 1.5+: the driver silently
+        ignores the options it does not know.
+        """
+
+        from neo4j.v1 import GraphDatabase, basic_auth
+
+        version = driver_version()
+        if version is not None and version < POOL_OPTIONS_VERSION:
+            log.warning("neo4j-driver %s ignores the pool options, "
+                        "1.5+ is required" % '.'.join(map(str, version)))
+
+        config.MAX_POOL_SIZE = int(
+            variables.get('max_pool_size', config.MAX_POOL_SIZE))
+        options = {
+            'encrypted': getattr(config, 'ENCRYPTED_CONNECTION', True),
+            'max_connection_pool_size': config.MAX_POOL_SIZE,
+        }
+        lifetime = variables.get('max_connection_lifetime')
+        if lifetime is not None:
+            options['max_connection_lifetime'] = int(lifetime)
+        timeout = variables.get('connection_acquisition_timeout')
+        if timeout is not None:
+            options['connection_acquisition_timeout'] = int(timeout)
+
+        address = "bolt://%s:%s" % (
+            variables.get('host'), variables.get('port'))
+        auth = basic_auth(
+            variables.get('user', 'neo4j'), variables.get('password'))
+        driver = GraphDatabase.driver(address, auth=auth, **options)
+
+        _shared_driver['driver'] = driver
+        _shared_driver['url'] = self.uri
+        _shared_driver['pid'] = os.getpid()
+        log.verbose("Neo4j driver pool of %s connections"
+                    % config.MAX_POOL_SIZE)
+
+    def custom_init(self, pinit=False, **kwargs):
+        """ Note: we ignore args here """
+
+        # recover instance with the parent method
+        obj = super().custom_init()
+
+        if pinit:
+            self.install_indexes()
+        self.check_indexes(obj)
+
+        return obj
+
+    def get_node_models(self):
+        from neomodel import StructuredNode
+        for name, model in sorted(self.models.items()):
+            if not isinstance(model, type) or \
+               not issubclass(model, StructuredNode):
+                continue
+            if model.__dict__.get('__abstract_node__', False):
+                continue
+            yield model
+
+    def install_indexes(self):
+        """ Indexes and constraints declared by base and custom models """
+
+        from neomodel import install_labels
+        for model in self.get_node_models():
+            install_labels(model)
+            log.verbose("Installed indexes for %s" % model.__name__)
+
+    def check_indexes(self, client):
+        """ Warn about declared indexes missing in the database schema """
+
+        expected = set()
+        for model in self.get_node_models():
+            properties = model.defined_properties(aliases=False, rels=False)
+            for name, prop in properties.items():
+                if prop.unique_index or prop.index:
+                    expected.add(
+                        (model.__label__, prop.db_property or name))
+
+        existing = set()
+        try:
+            results, _ = client.cypher_query(
+                "CALL db.indexes()", read_only=True)
+            for row in results:
+                match = INDEX_DESCRIPTION.search(row[0])
+                if match:
+                    existing.add(match.groups())
+            results, _ = client.cypher_query(
+                "CALL db.constraints()", read_only=True)
+            for row in results:
+                match = CONSTRAINT_DESCRIPTION.search(row[0])
+                if match:
+                    existing.add(match.groups())
+        except Exception as e:
+            log.warning("Unable to verify the neo4j schema: %s" % e)
+            return False
+
+        missing = sorted(expected - existing)
+        for label, name in missing:
+            log.warning("Missing neo4j index on :%s(%s)" % (label, name))
+        if len(missing) > 0:
+            log.warning("Initialize the project to install missing indexes")
+        return len(missing) < 1
+
+    def teardown(self, exception):
+        """
+        The sessions of the request go back to the pool; this happens
+        for every request, even when the shared client was already
+        released by another one.
+        """
+
+        sessions = getattr(g, SESSIONS_ATTRIBUTE, None)
+        if sessions:
+            close_sessions(sessions)
+            update_pool_metrics(db.driver)
+        super(NeoModel, self).teardown(exception)
@@ -27,6 +27,15 @@ DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = '5000'
 USER_HOME = os.environ['HOME']
 UPLOAD_FOLDER = '/uploads'
+# Internal nginx location mapped on UPLOAD_FOLDER, to offload downloads
+UPLOAD_ACCEL_REDIRECT = os.environ.get('UPLOAD_ACCEL_REDIRECT')
+# Upload admission, per process (0 means no limit)
+UPLOAD_MAX_CONCURRENT = int(os.environ.get('UPLOAD_MAX_CONCURRENT', 0))
+UPLOAD_MAX_USER_BYTES = int(os.environ.get('UPLOAD_MAX_USER_BYTES', 0))
+UPLOAD_MAX_TOTAL_BYTES = int(os.environ.get('UPLOAD_MAX_TOTAL_BYTES', 0))
+UPLOAD_MIN_FREE_BYTES = int(os.environ.get('UPLOAD_MIN_FREE_BYTES', 0))
+# Store identical uploads once, as read-only hardlinks by content digest
+UPLOAD_DEDUPLICATE = os.environ.get('UPLOAD_DEDUPLICATE', '0') == '1'
 SECRET_KEY_FILE = os.environ.get('JWT_APP_SECRETS') + "/secret.key"
 PRODUCTION = False
 # DEBUG = False
@@ -2,10 +2,22 @@
 
 """ Models for the relational database """
 
+import hashlib
+from sqlalchemy.orm import validates
 from flask_sqlalchemy import SQLAlchemy as OriginalAlchemy
+from rapydo.utils.logs import get_logger
+
+log = get_logger(__name__)
 db = OriginalAlchemy()
 
 
+def token_digest(token):
+    """ Fixed length (indexable) key to search a token """
+    if token is None:
+        return None
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
 ####################################
 # Define multi-multi relation
 roles_users = db.Table(
@@ -50,6 +62,7 @@ class Token(db.Model):
     jti = db.Column(db.String(36), unique=True)
     # token = db.Column(db.String(360), unique=True)
     token = db.Column(db.Text())
+    token_hash = db.Column(db.String(64), unique=True, index=True)
     creation = db.Column(db.DateTime)
     expiration = db.Column(db.DateTime)
     last_access = db.Column(db.DateTime)
@@ -59,6 +72,15 @@ class Token(db.Model):
     emitted_for = db.relationship(
         'User', backref=db.backref('tokens', lazy='dynamic'))
 
+    __table_args__ = (
+        db.Index('ix_token_user_expiration', 'user_id', 'expiration'),
+    )
+
+    @validates('token')
+    def update_token_hash(self, key, token):
+        self.token_hash = token_digest(token)
+        return token
+
     def __str__(self):
         return "[db model: %s] %s" % (self.__class__.__name__, self.token)
 
@@ -66,6 +88,7 @@ class Token(db.Model):
 class ExternalAccounts(db.Model):
     username = db.Column(db.String(60), primary_key=True)
     token = db.Column(db.Text())
+    token_hash = db.Column(db.String(64), index=True)
     token_expiration = db.Column(db.DateTime)
     email = db.Column(db.String(255))
     certificate_cn = db.Column(db.String(255))
@@ -78,6 +101,29 @@ class ExternalAccounts(db.Model):
     main_user = db.relationship(
         'User', backref=db.backref('authorization', lazy='dynamic'))
 
+    @validates('token')
+    def update_token_hash(self, key, token):
+        self.token_hash = token_digest(token)
+        return token
+
     def __str__(self):
         return "[db model: %s] %s(%s):%s" % (
             self.__class__.__name__, self.username, self.email, self.user_id)
+
+
+def upgrade(db):
+    """
+    Data migrations, run at project initialization
+    after adding missing columns:
+    digests of the tokens stored before token_hash existed
+    """
+
+    for model in (Token, ExternalAccounts):
+        rows = model.query.filter(
+            model.token_hash.is_(None), model.token.isnot(None)).all()
+        for row in rows:
+            row.token_hash = token_digest(row.token)
+        if len(rows) > 0:
+            db.session.commit()
+            log.info("Computed %s token digests for %s"
+                     % (len(rows), model.__name__))
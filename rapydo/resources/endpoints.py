@@ -394,6 +394,14 @@ class Admin(EndpointResource):
         return "I am admin!"
 
 
+class Metrics(EndpointResource):
+    """ Counters, latencies and slow calls of the services in use """
+
+    def get(self):
+        from rapydo.utils.metrics import get_all_metrics
+        return self.force_response(get_all_metrics())
+
+
 ###########################
 # In case you have celery queue,
 # you get a queue endpoint for free
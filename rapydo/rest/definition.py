@@ -12,6 +12,7 @@ from datetime import datetime
 from injector import inject
 from flask_restful import request, Resource, reqparse
 from rapydo.rest.response import ResponseElements
+from rapydo.rest.serializers import get_serializer
 from rapydo.utils import htmlcodes as hcodes
 from rapydo.utils.globals import mem
 from rapydo.services.detect import detector
@@ -394,10 +395,13 @@ class EndpointResource(Resource):
             log.warning("Errors parsing %s" % timestamp)
             return ""
 
-    def formatJsonResponse(self, instances, resource_type=None):
+    def formatJsonResponse(self, instances, resource_type=None, page=None):
         """
         Format specifications can be found here:
         http://jsonapi.org
+
+        'page' is the pagination info of the instances, if any:
+        {'links': {'next': ..., 'last': ...}, 'total': ...}
         """
 
         json_data = {}
@@ -407,6 +411,10 @@ class EndpointResource(Resource):
             "next": None,
             "last": None,
         }
+        if page is not None:
+            json_data["links"].update(page.get('links', {}))
+            if page.get('total') is not None:
+                json_data["meta"] = {"total": page['total']}
 
         json_data["content"] = []
         if not isinstance(instances, list):
@@ -414,138 +422,102 @@ class EndpointResource(Resource):
         if len(instances) < 1:
             return json_data
 
+        prefetched = self.prefetch_relationships(instances)
         for instance in instances:
-            json_data["content"].append(self.getJsonResponse(instance))
-
-        # TO FIX: get pages FROM SELF ARGS?
-        # json_data["links"]["next"] = \
-        #     endpoint + '?currentpage=2&perpage=1',
-        # json_data["links"]["last"] = \
-        #     endpoint + '?currentpage=' + str(len(instances)) + '&perpage=1',
+            json_data["content"].append(
+                self.getJsonResponse(instance, prefetched=prefetched))
 
         return json_data
 
     def getJsonResponse(self, instance,
                         fields=[], resource_type=None, skip_missing_ids=False,
                         view_public_only=False,
-                        relationship_depth=0, max_relationship_depth=1):
+                        relationship_depth=0, max_relationship_depth=1,
+                        prefetched=None):
         """
         Lots of meta introspection to guess the JSON specifications
         Very important: this method only works with customized neo4j models
-        """
-
-        if resource_type is None:
-            resource_type = type(instance).__name__.lower()
-
-        # Get id
-        verify_attribute = hasattr
-        if isinstance(instance, dict):
-            verify_attribute = dict.get
-        if verify_attribute(instance, "uuid"):
-            id = str(instance.uuid)
-        elif verify_attribute(instance, "id"):
-            id = str(instance.id)
-        else:
-            id = "-"
-
-        if id is None:
-            id = "-"
 
-        data = {
-            "id": id,
-            "type": resource_type,
-            "attributes": {}
-            # "links": {"self": request.url + '/' + id},
-        }
+        The introspection happens once per model (and options), inside
+        the serializer compiled for it: see rapydo.rest.serializers.
+        Related nodes are taken from 'prefetched' when available,
+        see prefetch_relationships
+        """
 
-        if skip_missing_ids and id == '-':
-            del data['id']
+        serializer = get_serializer(
+            type(instance), fields, resource_type,
+            skip_missing_ids=skip_missing_ids,
+            view_public_only=view_public_only,
+            relationship_depth=relationship_depth,
+            max_relationship_depth=max_relationship_depth)
 
-        # TO FIX: for now is difficult to compute self links for relationships
+        self_uri = None
         if relationship_depth == 0:
             self_uri = request.url
-            if not self_uri.endswith(id):
-                self_uri += '/' + id
-            data["links"] = {"self": self_uri}
-
-        # Attributes
-        if len(fields) < 1:
-
-            function_name = 'show_fields'
-            if hasattr(instance, function_name):
-                fn = getattr(instance, function_name)
-                fields = fn(view_public_only=view_public_only)
-
-            else:
-
-                if view_public_only:
-                    field_name = '_public_fields_to_show'
-                else:
-                    field_name = '_fields_to_show'
-
-                if hasattr(instance, field_name):
-                    log.warning("Obsolete use of %s into models" % field_name)
-                    fields = getattr(instance, field_name)
-
-        for key in fields:
-            if verify_attribute(instance, key):
-                get_attribute = getattr
-                if isinstance(instance, dict):
-                    get_attribute = dict.get
-
-                attribute = get_attribute(instance, key)
-                # datetime is not json serializable,
-                # converting it to string
-                # TO FIX: use flask.jsonify
-                if attribute is None:
-                    data["attributes"][key] = ""
-                elif isinstance(attribute, datetime):
-                    dval = self.string_from_timestamp(attribute.strftime('%s'))
-                    data["attributes"][key] = dval
-                else:
-                    data["attributes"][key] = attribute
-
-        # Relationships
-        if relationship_depth < max_relationship_depth:
-            linked = {}
-            relationships = []
-
-            function_name = 'follow_relationships'
-            if hasattr(instance, function_name):
-                fn = getattr(instance, function_name)
-                relationships = fn(view_public_only=view_public_only)
-
-            else:
-
-                if view_public_only:
-                    field_name = '_public_relationships_to_follow'
-                else:
-                    field_name = '_relationships_to_follow'
-
-                if hasattr(instance, field_name):
-                    log.warning("Obsolete use of %s into models" % field_name)
-                    relationships = getattr(instance, field_name)
-
-            for relationship in relationships:
-                subrelationship = []
-                # log.debug("Investigate relationship %s" % relationship)
+        return serializer(instance, self_uri, prefetched)
 
-                if hasattr(instance, relationship):
-                    for node in getattr(instance, relationship).all():
-                        subrelationship.append(
-                            self.getJsonResponse(
-                                node,
-                                view_public_only=view_public_only,
-                                skip_missing_ids=skip_missing_ids,
-                                relationship_depth=relationship_depth + 1,
-                                max_relationship_depth=max_relationship_depth))
-
-                linked[relationship] = subrelationship
+    def prefetch_relationships(self, instances, view_public_only=False,
+                               max_relationship_depth=1):
+        """
+        Load the relationships to be followed by getJsonResponse for
+        a list of neomodel instances, with one Cypher query for each
+        relationship of each model (and level) instead of one per node.
 
-            if len(linked) > 0:
-                data['relationships'] = linked
+        Returns a dict: (node id, relationship name) => related nodes
+        """
 
-        return data
+        prefetched = {}
+        level = [
+            i for i in instances
+            if hasattr(i, 'follow_relationships') and
+            getattr(i, 'id', None) is not None
+        ]
+        if len(level) < 1:
+            return prefetched
+
+        from neomodel.match import _rel_helper
+        graph = getattr(self, 'graph', None)
+        if graph is None:
+            graph = self.get_service_instance('neo4j')
+
+        depth = 0
+        while len(level) > 0 and depth < max_relationship_depth:
+
+            groups = {}
+            for instance in level:
+                groups.setdefault(type(instance), []).append(instance)
+
+            next_level = {}
+            for model, nodes in groups.items():
+                ids = list(set(node.id for node in nodes))
+                for relationship in model.follow_relationships(
+                        view_public_only=view_public_only):
+
+                    # the manager of an instance has the resolved node class
+                    definition = getattr(nodes[0], relationship).definition
+                    node_class = definition['node_class']
+                    # the target label, as in neomodel traversals: types
+                    # may be shared by relationships to other classes
+                    pattern = _rel_helper(
+                        lhs='n', rhs='m:`%s`' % node_class.__label__,
+                        relation_type=definition['relation_type'],
+                        direction=definition['direction'])
+                    query = "MATCH %s WHERE id(n) IN $ids RETURN id(n), m" \
+                        % pattern
+
+                    for node_id in ids:
+                        prefetched[(node_id, relationship)] = []
+                    results, _ = graph.cypher_query(
+                        query, {'ids': ids}, read_only=True)
+                    for node_id, row in results:
+                        related = node_class.inflate(row)
+                        prefetched[(node_id, relationship)].append(related)
+                        next_level[related.id] = related
+
+            level = list(next_level.values())
+            depth += 1
+
+        return prefetched
 
     def get_endpoint_definition(self, key=None,
                                 is_schema_url=False, method=None):
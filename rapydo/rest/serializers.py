@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled serializers for the JSON responses of the endpoints.
+
+Everything getJsonResponse used to decide for each instance (dict or
+object, which id to use, fields and relationships of the model) is
+decided once per (model, fields, view, depth) and captured in a
+specialized function, kept in a cache.
+
+Nodes per second on a typical model:
+    python -m rapydo.rest.serializers
+"""
+
+from datetime import datetime
+
+_serializers = {}
+
+
+def format_attribute(value):
+    """ Datetimes are not json serializable: converted to strings """
+
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        # the same result of the old round trip from the epoch:
+        # local wall time, without microseconds and timezone
+        return value.replace(microsecond=0, tzinfo=None).isoformat()
+    return value
+
+
+def model_metadata(model, view_public_only):
+    """ Fields and relationships, from the model or the obsolete lists """
+
+    fields = []
+    if hasattr(model, 'show_fields'):
+        fields = model.show_fields(view_public_only=view_public_only)
+    else:
+        field_name = '_fields_to_show'
+        if view_public_only:
+            field_name = '_public_fields_to_show'
+        if hasattr(model, field_name):
+            fields = getattr(model, field_name)
+
+    relationships = []
+    if hasattr(model, 'follow_relationships'):
+        relationships = model.follow_relationships(
+            view_public_only=view_public_only)
+    else:
+        field_name = '_relationships_to_follow'
+        if view_public_only:
+            field_name = '_public_relationships_to_follow'
+        if hasattr(model, field_name):
+            relationships = getattr(model, field_name)
+
+    return tuple(fields), tuple(relationships)
+
+
+def get_serializer(model, fields=(), resource_type=None,
+                   skip_missing_ids=False, view_public_only=False,
+                   relationship_depth=0, max_relationship_depth=1):
+    """
+    The function serializing instances of 'model', as:
+        serializer(instance, self_uri=None, prefetched=None)
+    """
+
+    key = (model, tuple(fields), resource_type, skip_missing_ids,
+           view_public_only, relationship_depth, max_relationship_depth)
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = compile_serializer(*key)
+        _serializers[key] = serializer
+    return serializer
+
+
+def compile_serializer(model, fields, resource_type, skip_missing_ids,
+                       view_public_only, relationship_depth,
+                       max_relationship_depth):
+
+    if resource_type is None:
+        resource_type = model.__name__.lower()
+
+    is_dict = issubclass(model, dict)
+
+    model_fields, relationships = (), ()
+    if not is_dict:
+        model_fields, relationships = model_metadata(model, view_public_only)
+    if len(fields) < 1:
+        fields = model_fields
+    if relationship_depth >= max_relationship_depth:
+        relationships = ()
+
+    # How to read the id
+    if is_dict:
+        def get_id(instance):
+            if instance.get("uuid"):
+                return str(instance.get("uuid"))
+            if instance.get("id"):
+                return str(instance.get("id"))
+            return "-"
+    elif hasattr(model, 'uuid'):
+        def get_id(instance):
+            return str(instance.uuid)
+    else:
+        def get_id(instance):
+            value = getattr(instance, 'uuid', None)
+            if value is None:
+                value = getattr(instance, 'id', None)
+            if value is None:
+                return "-"
+            return str(value)
+
+    # How to read the attributes
+    if is_dict:
+        def get_attributes(instance):
+            return {
+                key: format_attribute(instance.get(key))
+                for key in fields if instance.get(key)
+            }
+    else:
+        missing = object()
+
+        def get_attributes(instance):
+            attributes = {}
+            for key in fields:
+                value = getattr(instance, key, missing)
+                if value is not missing:
+                    attributes[key] = format_attribute(value)
+            return attributes
+
+    with_links = relationship_depth == 0
+
+    def serializer(instance, self_uri=None, prefetched=None):
+
+        id = get_id(instance)
+        data = {
+            "id": id,
+            "type": resource_type,
+            "attributes": get_attributes(instance),
+        }
+
+        if skip_missing_ids and id == '-':
+            del data['id']
+
+        # TO FIX: for now is difficult to compute self links for relationships
+        if with_links and self_uri is not None:
+            if not self_uri.endswith(id):
+                self_uri += '/' + id
+            data["links"] = {"self": self_uri}
+
+        if len(relationships) > 0:
+            linked = {}
+            for relationship in relationships:
+                nodes = None
+                if prefetched is not None:
+                    nodes = prefetched.get(
+                        (getattr(instance, 'id', None), relationship))
+                if nodes is None and hasattr(instance, relationship):
+                    nodes = getattr(instance, relationship).all()
+
+                subrelationship = []
+                for node in nodes or []:
+                    subserializer = get_serializer(
+                        type(node),
+                        skip_missing_ids=skip_missing_ids,
+                        view_public_only=view_public_only,
+                        relationship_depth=relationship_depth + 1,
+                        max_relationship_depth=max_relationship_depth)
+                    subrelationship.append(
+                        subserializer(node, prefetched=prefetched))
+                linked[relationship] = subrelationship
+
+            data['relationships'] = linked
+
+        return data
+
+    return serializer
+
+
+def benchmark(size=10000, repeat=5):
+    """ Nodes per second, for a model similar to the timestamped nodes """
+
+    import time
+
+    class Group(object):
+
+        @classmethod
+        def show_fields(cls, view_public_only=False):
+            return ['shortname', 'fullname']
+
+        @classmethod
+        def follow_relationships(cls, view_public_only=False):
+            return []
+
+    class Sample(object):
+
+        @classmethod
+        def show_fields(cls, view_public_only=False):
+            return ['name', 'description', 'size', 'created', 'modified']
+
+        @classmethod
+        def follow_relationships(cls, view_public_only=False):
+            return ['group']
+
+    now = datetime.now()
+    instances = []
+    prefetched = {}
+    for i in range(size):
+        sample = Sample()
+        sample.id = i
+        sample.uuid = "uuid-%s" % i
+        sample.name = "sample %s" % i
+        sample.description = "a description"
+        sample.size = i * 1024
+        sample.created = now
+        sample.modified = now
+
+        group = Group()
+        group.id = size + i
+        group.uuid = "group-%s" % i
+        group.shortname = "g%s" % i
+        group.fullname = "Group %s" % i
+        prefetched[(i, 'group')] = [group]
+        instances.append(sample)
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for instance in instances:
+            serializer = get_serializer(type(instance))
+            serializer(instance, '/api/samples', prefetched)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print("%s nodes (with one related node each): %.0f nodes/sec"
+          % (size, size / max(best, 1e-9)))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -9,6 +9,7 @@ from datetime import datetime, timedelta
 from rapydo.utils.uuid import getUUID
 from rapydo.services.authentication import BaseAuthentication
 from rapydo.services.detect import detector
+from rapydo.models.sqlalchemy import token_digest
 from rapydo.utils.logs import get_logger
 
 log = get_logger(__name__)
@@ -188,7 +189,8 @@ class Authentication(BaseAuthentication):
         if user is None:
             user = self.get_user()
 
-        token_entry = self.db.Token.query.filter_by(token=token).first()
+        token_entry = self.db.Token.query.filter_by(
+            token_hash=token_digest(token)).first()
         if token_entry is not None:
             token_entry.emitted_for = None
             self.db.session.commit()
@@ -298,7 +300,8 @@ class Authentication(BaseAuthentication):
 # TO FIX: make this methods below abstract for graph and others too?
 
     def oauth_from_token(self, token):
-        extus = self.db.ExternalAccounts.query.filter_by(token=token).first()
+        extus = self.db.ExternalAccounts.query.filter_by(
+            token_hash=token_digest(token)).first()
         intus = extus.main_user
         # print(token, intus, extus)
         return intus, extus
@@ -210,12 +210,14 @@ class Detector(object):
             self.extensions_instances[name] = ext_instance
 
             # Injecting into the Celery Extension Class
-            # all celery tasks found in *vanilla_package/tasks*
+            # base tasks and all celery tasks found in *vanilla_package/tasks*
             if name == self.task_service_name:
 
                 task_package = "%s.tasks" % CUSTOM_PACKAGE
 
-                submodules = self.meta.import_submodules_from_package(
+                submodules = [self.meta.get_module_from_string(
+                    'flask_ext.flask_celery.tasks', exit_on_fail=True)]
+                submodules += self.meta.import_submodules_from_package(
                     task_package, exit_on_fail=True)
                 for submodule in submodules:
                     tasks = self.meta.get_celery_tasks_from_module(submodule)
@@ -1,20 +1,68 @@
 # -*- coding: utf-8 -*-
 
 import re
-# from datetime import datetime
+import json
+import math
+import time
+import base64
+import random
+import threading
+from collections import OrderedDict
+from datetime import datetime
 # import pytz
 from functools import wraps
+from urllib.parse import urlencode
+from flask import request
 # from py2neo.error import GraphError
 # from py2neo.cypher.error.schema import ConstraintViolation
 from rapydo.exceptions import RestApiException
-from rapydo.rest.definition import EndpointResource
+from rapydo.rest.definition import EndpointResource, \
+    CURRENTPAGE_KEY, PERPAGE_KEY
 from rapydo.utils import htmlcodes as hcodes
+from flask_ext.flask_neo4j import transient_graph_exceptions
 
 from rapydo.utils.logs import get_logger
 log = get_logger(__name__)
 
 __author__ = "Mattia D'Antonio (m.dantonio@cineca.it)"
 
+CURSOR_KEY = 'cursor'
+DEFAULT_BULK_BATCH_SIZE = 1000
+DEFAULT_TRANSACTION_RETRIES = 3
+DEFAULT_TRANSACTION_BACKOFF = 0.1
+DEFAULT_TRANSACTION_MAX_BACKOFF = 2
+COUNT_CACHE_TTL = 60
+COUNT_CACHE_SIZE = 1000
+
+# count query key => (total, expiration), least recently used first
+_counts_cache = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+def cached_count(key):
+    with _counts_lock:
+        total, expiration = _counts_cache.get(key, (None, 0))
+        if expiration <= time.time():
+            return None
+        _counts_cache.move_to_end(key)
+        return total
+
+
+def cache_count(key, total, max_size=COUNT_CACHE_SIZE):
+    """ Keys depend on request arguments: the cache must stay bounded """
+
+    now = time.time()
+    with _counts_lock:
+        _counts_cache.pop(key, None)
+        if len(_counts_cache) >= max_size:
+            for old_key, (_, expiration) in list(_counts_cache.items()):
+                if expiration <= now:
+                    del _counts_cache[old_key]
+        # still full: drop the least recently used
+        while len(_counts_cache) >= max_size:
+            _counts_cache.popitem(last=False)
+        _counts_cache[key] = (total, now + COUNT_CACHE_TTL)
+
 
 class GraphBaseOperations(EndpointResource):
 
@@ -48,6 +96,218 @@ class GraphBaseOperations(EndpointResource):
         except Model.DoesNotExist:
             return None
 
+    # BULK WRITES
+
+    def bulk_merge(self, Model, rows, key,
+                   batch_size=DEFAULT_BULK_BATCH_SIZE):
+        """
+        Create or update many nodes of Model, matched by their 'key'
+        property, with one UNWIND ... MERGE query per batch of rows
+        instead of a save() for each node.
+
+        New nodes are validated as a whole and also get the defaults
+        of the model (e.g. uuid and creation dates); existing ones only
+        get (and validate) the given properties.
+        Validation and constraint errors are raised as neomodel
+        exceptions, to be mapped by catch_graph_exceptions.
+
+        Returns the counts: {'created': ..., 'updated': ...}
+        """
+
+        properties = Model.defined_properties(aliases=False, rels=False)
+        if key not in properties:
+            raise AttributeError(
+                "%s has no property %s" % (Model.__name__, key))
+        db_key = properties[key].db_property or key
+
+        labels = Model.inherited_labels()
+        extra_labels = ''.join(
+            ':`%s`' % label for label in labels if label != Model.__label__)
+        query = """
+            UNWIND $rows AS row
+            MERGE (n:`{label}` {{`{key}`: row.key}})
+            ON CREATE SET n += row.create, n.`_bulk_created` = true{extra}
+            SET n += row.props
+            WITH n, n.`_bulk_created` IS NOT NULL AS created
+            REMOVE n.`_bulk_created`
+            RETURN sum(CASE WHEN created THEN 1 ELSE 0 END), count(n)
+        """.format(
+            label=Model.__label__, key=db_key,
+            extra=', n' + extra_labels if extra_labels else '')
+        existing_query = """
+            MATCH (n:`{label}`) WHERE n.`{key}` IN $keys
+            RETURN n.`{key}`
+        """.format(label=Model.__label__, key=db_key)
+
+        created = 0
+        updated = 0
+        for start in range(0, len(rows), batch_size):
+
+            batch = []
+            for row in rows[start:start + batch_size]:
+                if row.get(key) is None:
+                    raise RestApiException(
+                        'Missing field: %s' % key,
+                        status_code=hcodes.HTTP_BAD_REQUEST)
+                # only the given properties, with their names in neo4j
+                props = {}
+                for name, value in row.items():
+                    prop = properties.get(name)
+                    if prop is None or value is None:
+                        continue
+                    props[prop.db_property or name] = prop.deflate(value)
+                batch.append({'key': props[db_key], 'props': props})
+
+            results, _ = self.graph.cypher_query(
+                existing_query, {'keys': [r['key'] for r in batch]},
+                read_only=True)
+            existing = set(r[0] for r in results)
+
+            for row, merge in zip(rows[start:start + batch_size], batch):
+                if merge['key'] in existing:
+                    # ON CREATE applies only if removed meanwhile
+                    merge['create'] = merge['props']
+                    continue
+                # defaults and required properties, by the constructor
+                instance = Model(**row)
+                merge['create'] = Model.deflate(
+                    instance.__properties__, instance)
+
+            results, _ = self.graph.cypher_query(query, {'rows': batch})
+            batch_created, batch_total = results[0]
+            created += batch_created
+            updated += batch_total - batch_created
+            log.verbose("Merged %s %s nodes (%s new)"
+                        % (batch_total, Model.__name__, batch_created))
+
+        return {'created': created, 'updated': updated}
+
+    # PAGINATION
+
+    def paginate(self, source, model=None, params=None,
+                 keyset=None, count=False, count_query=None):
+        """
+        Load a single page of nodes, with SKIP/LIMIT done by neo4j.
+
+        'source' is a neomodel NodeSet or a Cypher query returning
+        the nodes in its first column (inflated with 'model', if given).
+        With a keyset ('uuid' or 'created') NodeSets are paginated with
+        a cursor on that property instead of skipping rows.
+        Totals are optional and come from a separate (cached) query:
+        the length of the NodeSet or the given count_query.
+
+        Returns the nodes and the page info for formatJsonResponse.
+        Note: call get_input before, to parse the paging parameters
+        """
+
+        current_page, limit = self.get_paging()
+        current_page = max(current_page, 1)
+        limit = max(limit, 1)
+        is_query = isinstance(source, str)
+
+        total = None
+        if count:
+            total = self.count_nodes(source, params, count_query)
+
+        cursor = None
+        if keyset is not None:
+            if is_query:
+                raise AttributeError(
+                    "Keyset pagination is only available for NodeSets")
+            nodes = source.order_by(keyset)
+            cursor = request.args.get(CURSOR_KEY)
+            if cursor is not None:
+                filters = {keyset + '__gt': self.decode_cursor(cursor)}
+                nodes = nodes.filter(**filters)
+            # one more, to know if there is a next page
+            items = nodes[:limit + 1]
+        elif is_query:
+            query_params = dict(params or {})
+            query_params['skip'] = (current_page - 1) * limit
+            query_params['limit'] = limit + 1
+            results, _ = self.graph.cypher_query(
+                source + " SKIP $skip LIMIT $limit", query_params,
+                read_only=True)
+            items = [row[0] for row in results]
+            if model is not None:
+                items = [model.inflate(node) for node in items]
+        else:
+            skip = (current_page - 1) * limit
+            items = source[skip:skip + limit + 1]
+
+        items = list(items)
+        has_next = len(items) > limit
+        items = items[:limit]
+
+        links = {'next': None, 'last': None}
+        if has_next:
+            if keyset is not None:
+                last_value = getattr(items[-1], keyset)
+                links['next'] = self.page_link(
+                    limit, cursor=self.encode_cursor(last_value))
+            else:
+                links['next'] = self.page_link(limit, page=current_page + 1)
+        if total is not None and keyset is None:
+            last_page = max(1, int(math.ceil(total / limit)))
+            links['last'] = self.page_link(limit, page=last_page)
+
+        return items, {'links': links, 'total': total}
+
+    def count_nodes(self, source, params=None, count_query=None):
+
+        # same endpoint, same filters, same user: same count
+        args = sorted(
+            (k, v) for k, v in request.args.items(multi=True)
+            if k not in (CURRENTPAGE_KEY, PERPAGE_KEY, CURSOR_KEY))
+        user = self.get_current_user()
+        key = (request.path, tuple(args), getattr(user, 'email', None),
+               count_query, json.dumps(params, sort_keys=True, default=str))
+
+        total = cached_count(key)
+        if total is not None:
+            return total
+
+        if isinstance(source, str):
+            if count_query is None:
+                return None
+            results, _ = self.graph.cypher_query(
+                count_query, params, read_only=True)
+            total = results[0][0]
+        else:
+            total = len(source)
+
+        cache_count(key, total)
+        return total
+
+    @staticmethod
+    def page_link(limit, page=None, cursor=None):
+        args = request.args.to_dict()
+        args[PERPAGE_KEY] = limit
+        if page is not None:
+            args[CURRENTPAGE_KEY] = page
+        if cursor is not None:
+            args[CURSOR_KEY] = cursor
+            args.pop(CURRENTPAGE_KEY, None)
+        return request.base_url + '?' + urlencode(args)
+
+    @staticmethod
+    def encode_cursor(value):
+        if isinstance(value, datetime):
+            value = {'timestamp': value.timestamp()}
+        data = json.dumps(value).encode()
+        return base64.urlsafe_b64encode(data).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            raise RestApiException(
+                "Invalid cursor: %s" % cursor,
+                status_code=hcodes.HTTP_BAD_REQUEST)
+        if isinstance(value, dict) and 'timestamp' in value:
+            value = self.timestamp_from_string(value['timestamp'])
+        return value
+
     # HANDLE INPUT PARAMETERS
 
     @staticmethod
@@ -120,30 +380,74 @@ class GraphBaseOperations(EndpointResource):
 
 
 def graph_transactions(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        try:
-            from neomodel import db as transaction
+    """ The function runs in a single transaction, without retries """
+    return graph_retry_transactions(max_retries=0)(func)
 
-            log.verbose("Neomodel transaction BEGIN")
-            transaction.begin()
 
-            out = func(self, *args, **kwargs)
+def graph_retry_transactions(read_only=False,
+                             max_retries=DEFAULT_TRANSACTION_RETRIES,
+                             backoff=DEFAULT_TRANSACTION_BACKOFF,
+                             max_backoff=DEFAULT_TRANSACTION_MAX_BACKOFF):
+    """
+    Like graph_transactions, but transient errors make the whole
+    function run again in a new transaction (after a random wait
+    growing exponentially), up to max_retries times.
+    Read only transactions (e.g. for GET) may be routed to followers.
 
-            log.verbose("Neomodel transaction COMMIT")
-            transaction.commit()
+    Note: side effects of the function outside neo4j are repeated too
 
-            return out
-        except Exception as e:
-            log.verbose("Neomodel transaction ROLLBACK")
-            try:
-                transaction.rollback()
-            except Exception as rollback_exp:
-                log.warning(
-                    "Exception raised during rollback: %s" % rollback_exp)
-            raise e
+        @graph_retry_transactions(read_only=True)
+        def get(self, ...):
+    """
 
-    return wrapper
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            from neomodel import db as transaction
+            transient = transient_graph_exceptions()
+
+            attempt = 0
+            while True:
+                try:
+                    log.verbose("Neomodel transaction BEGIN")
+                    if read_only:
+                        try:
+                            transaction.begin(access_mode='READ')
+                        except TypeError:
+                            # neomodel without access modes
+                            transaction.begin()
+                    else:
+                        transaction.begin()
+
+                    out = func(self, *args, **kwargs)
+
+                    log.verbose("Neomodel transaction COMMIT")
+                    transaction.commit()
+
+                    return out
+                except Exception as e:
+                    log.verbose("Neomodel transaction ROLLBACK")
+                    try:
+                        transaction.rollback()
+                    except Exception as rollback_exp:
+                        log.warning(
+                            "Exception raised during rollback: %s"
+                            % rollback_exp)
+
+                    if not isinstance(e, transient) or \
+                       attempt >= max_retries:
+                        raise e
+
+                    attempt += 1
+                    wait = random.uniform(
+                        0, min(max_backoff, backoff * 2 ** attempt))
+                    log.warning(
+                        "Transient error (%s), retry %s/%s in %.2f seconds"
+                        % (e, attempt, max_retries, wait))
+                    time.sleep(wait)
+
+        return wrapper
+    return decorator
 
 
 def catch_graph_exceptions(func):
@@ -22,6 +22,9 @@ from neomodel.relationship_manager import RelationshipDefinition
 
 from rapydo.utils.uuid import getUUID
 
+# (model class, view_public_only) => (fields, relationships)
+_introspection_cache = {}
+
 
 def RelationshipTo(
         cls_name, rel_type,
@@ -210,6 +213,32 @@ class StructuredNode(originalStructuredNode):
 
     @classmethod
     def show_fields(cls, view_public_only=False):
+        return list(cls.introspect(view_public_only)[0])
+
+    @classmethod
+    def follow_relationships(cls, view_public_only=False):
+        return list(cls.introspect(view_public_only)[1])
+
+    @classmethod
+    def introspect(cls, view_public_only=False):
+        """
+        Fields to show and relationships to follow, as tuples.
+        The class hierarchy is inspected only once per class and view,
+        then memoized: the models do not change after their definition.
+        """
+
+        key = (cls, view_public_only)
+        metadata = _introspection_cache.get(key)
+        if metadata is None:
+            metadata = (
+                tuple(cls._inspect_fields(view_public_only)),
+                tuple(cls._inspect_relationships(view_public_only)),
+            )
+            _introspection_cache[key] = metadata
+        return metadata
+
+    @classmethod
+    def _inspect_fields(cls, view_public_only=False):
 
         fields_to_show = []
 
@@ -232,7 +261,7 @@ class StructuredNode(originalStructuredNode):
         return fields_to_show
 
     @classmethod
-    def follow_relationships(cls, view_public_only=False):
+    def _inspect_relationships(cls, view_public_only=False):
 
         relationship_to_follow = []
 
@@ -13,16 +13,153 @@ http://stackoverflow.com/a/9533843/2114395
 """
 
 import os
+import fcntl
+import hashlib
+import shutil
+import threading
+import mimetypes
+from contextlib import contextmanager
 # import shutil
 # import subprocess as shell
-from flask import request, send_from_directory
+from flask import request, current_app, Response
 from werkzeug import secure_filename
+from werkzeug.http import http_date, quote_etag
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+from rapydo.exceptions import RestApiException
 from rapydo.utils import htmlcodes as hcodes
-from rapydo.confs import UPLOAD_FOLDER
+from rapydo.confs import UPLOAD_FOLDER, UPLOAD_ACCEL_REDIRECT, \
+    UPLOAD_MAX_CONCURRENT, UPLOAD_MAX_USER_BYTES, \
+    UPLOAD_MAX_TOTAL_BYTES, UPLOAD_MIN_FREE_BYTES, UPLOAD_DEDUPLICATE
+from rapydo.utils.filetypes import detect_type, SNIFF_SIZE
+from rapydo.utils.downloads import requested_range, content_disposition
 
 from rapydo.utils.logs import get_logger
 log = get_logger(__name__)
 
+# Chunked uploads: data being assembled and bitmap of the chunks received
+PARTIAL_SUFFIX = '.part'
+CHUNKS_SUFFIX = '.chunks'
+COPY_BUFFER_SIZE = 65536
+# Deduplicated storage: one file per content digest, inside UPLOAD_FOLDER
+OBJECTS_FOLDER = '.objects'
+OBJECTS_LOCK = '.lock'
+DIGEST_XATTR = 'user.rapydo.sha256'
+
+
+class UploadAdmission(object):
+    """
+    Admission control for uploads, checked before reading the body.
+
+    Each user gets a number of concurrent uploads and a quota of bytes
+    in flight; a global quota of bytes in flight protects the whole
+    folder, together with the free disk space (minus what is still
+    being received). Limits set to 0 are disabled.
+
+    Quotas only count the uploads being received, not the bytes
+    already stored in the upload folder.
+
+    Counters live in memory: with several server processes (workers)
+    each one applies the limits on its own uploads only, so the total
+    quota may be exceeded up to the number of processes.
+    """
+
+    def __init__(self, max_concurrent=UPLOAD_MAX_CONCURRENT,
+                 max_user_bytes=UPLOAD_MAX_USER_BYTES,
+                 max_total_bytes=UPLOAD_MAX_TOTAL_BYTES,
+                 min_free_bytes=UPLOAD_MIN_FREE_BYTES):
+        self.max_concurrent = max_concurrent
+        self.max_user_bytes = max_user_bytes
+        self.max_total_bytes = max_total_bytes
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._user_bytes = {}
+        self._total_bytes = 0
+
+    def acquire(self, user, size, folder=UPLOAD_FOLDER):
+        """ Reserve a slot and 'size' bytes, or raise a RestApiException """
+
+        # the length is needed only by limits on bytes
+        limit_bytes = self.max_user_bytes > 0 or \
+            self.max_total_bytes > 0 or self.min_free_bytes > 0
+
+        if size is None:
+            if limit_bytes:
+                raise RestApiException(
+                    "Missing Content-Length",
+                    status_code=hcodes.HTTP_BAD_LENGTH_REQUIRED)
+            size = 0
+
+        if self.max_user_bytes > 0 and size > self.max_user_bytes or \
+           self.max_total_bytes > 0 and size > self.max_total_bytes:
+            raise RestApiException(
+                "Upload of %s bytes exceeds the allowed size" % size,
+                status_code=hcodes.HTTP_BAD_REQUEST_ENTITY_TOO_LARGE)
+
+        with self._lock:
+
+            slots = self._slots.get(user, 0)
+            if self.max_concurrent > 0 and slots >= self.max_concurrent:
+                raise RestApiException(
+                    "Too many uploads in progress, retry later",
+                    status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+            user_bytes = self._user_bytes.get(user, 0)
+            if self.max_user_bytes > 0 and \
+               user_bytes + size > self.max_user_bytes:
+                raise RestApiException(
+                    "Upload quota in use, retry later",
+                    status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+            if self.max_total_bytes > 0 and \
+               self._total_bytes + size > self.max_total_bytes:
+                raise RestApiException(
+                    "Server busy with other uploads, retry later",
+                    status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+            if limit_bytes:
+                try:
+                    free = shutil.disk_usage(folder).free
+                except OSError as e:
+                    log.error("Cannot check the space of %s: %s"
+                              % (folder, e))
+                    raise RestApiException(
+                        "Upload folder not available",
+                        status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
+                free -= self._total_bytes
+                if free - self.min_free_bytes < size:
+                    raise RestApiException(
+                        "Not enough space left for %s bytes" % size,
+                        status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+            self._slots[user] = slots + 1
+            self._user_bytes[user] = user_bytes + size
+            self._total_bytes += size
+
+        return user, size
+
+    def release(self, ticket):
+        user, size = ticket
+        with self._lock:
+            self._total_bytes -= size
+            self._user_bytes[user] -= size
+            self._slots[user] -= 1
+            if self._slots[user] < 1:
+                self._slots.pop(user)
+                self._user_bytes.pop(user)
+
+    @contextmanager
+    def admitted(self, user, size, folder=UPLOAD_FOLDER):
+        ticket = self.acquire(user, size, folder)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+
+upload_admission = UploadAdmission()
+
 
 ######################################
 # Save files http://API/upload
@@ -30,6 +167,7 @@ class Uploader(object):
 
     allowed_exts = []
     # allowed_exts = ['png', 'jpg', 'jpeg', 'tiff']
+    deduplicate = UPLOAD_DEDUPLICATE
 
     def split_dir_and_extension(self, filepath):
         filebase, fileext = os.path.splitext(filepath)
@@ -53,6 +191,78 @@ class Uploader(object):
             return os.path.dirname(abs_file)
         return abs_file
 
+    @staticmethod
+    def absolute_object_file(digest=None):
+        """ Where the content with this (hex sha256) digest is stored """
+        folder = os.path.join(UPLOAD_FOLDER, OBJECTS_FOLDER)
+        if digest is None:
+            return folder
+        return os.path.join(folder, digest[:2], digest)
+
+    @contextmanager
+    def locked_objects(self):
+        folder = self.absolute_object_file()
+        os.makedirs(folder, exist_ok=True)
+        with self.locked_file(os.path.join(folder, OBJECTS_LOCK)) as fd:
+            yield fd
+
+    def link_object(self, digest, abs_file, new_file):
+        """
+        Expose a stored content as abs_file, hashed from the received
+        new_file: it becomes the stored one if missing.
+
+        Stored contents are read-only: all the names of a content share
+        its inode, an in-place write would change every one of them.
+        To modify an uploaded file, write a copy and replace it.
+        """
+
+        object_file = self.absolute_object_file(digest)
+        with self.locked_objects():
+            if not os.path.exists(object_file):
+                os.makedirs(os.path.dirname(object_file), exist_ok=True)
+                os.chmod(new_file, 0o444)
+                os.rename(new_file, object_file)
+                try:
+                    os.setxattr(object_file, DIGEST_XATTR, digest.encode())
+                except (AttributeError, OSError):
+                    # remove will hash the file instead
+                    pass
+            else:
+                os.remove(new_file)
+                log.info("Content of %s already stored" % abs_file)
+            os.link(object_file, abs_file)
+
+    def unlink_object(self, abs_file):
+        """ Remove a name, and the stored content when no one uses it """
+
+        # stored contents have at least two links (object and name):
+        # a single link is a file never deduplicated, e.g. chunked uploads
+        if os.stat(abs_file).st_nlink < 2:
+            os.remove(abs_file)
+            return
+
+        try:
+            digest = os.getxattr(abs_file, DIGEST_XATTR).decode()
+        except (AttributeError, OSError):
+            hasher = hashlib.sha256()
+            with open(abs_file, 'rb') as handle:
+                for data in iter(lambda: handle.read(COPY_BUFFER_SIZE), b''):
+                    hasher.update(data)
+            digest = hasher.hexdigest()
+
+        object_file = self.absolute_object_file(digest)
+        with self.locked_objects():
+            inode = os.stat(abs_file).st_ino
+            os.remove(abs_file)
+            try:
+                stat = os.stat(object_file)
+                # the last name of this content is gone
+                if stat.st_ino == inode and stat.st_nlink < 2:
+                    os.remove(object_file)
+                    log.debug("Removed stored content %s" % digest)
+            except FileNotFoundError:
+                pass
+
     def download(self, filename=None, subfolder=None, get=False):
 
         if not get:
@@ -67,12 +277,132 @@ class Uploader(object):
             filename, subfolder=subfolder, onlydir=True)
         log.info("Provide '%s' from '%s' " % (filename, path))
 
-        return send_from_directory(path, filename)
+        abs_file = safe_join(path, filename)
+        if abs_file is None or not os.path.isfile(abs_file):
+            return self.force_response(errors={
+                "File missing": "File requested does not exists"},
+                code=hcodes.HTTP_BAD_NOTFOUND)
+
+        return self.send_file_response(abs_file)
+
+    def send_file_response(self, abs_file):
+        """
+        Serve a local file without copying it through python when possible.
+
+        Conditional (If-None-Match) and partial (Range, If-Range) requests
+        are handled here; the body is then delegated to the fronting nginx
+        (X-Accel-Redirect, see UPLOAD_ACCEL_REDIRECT) or to any other proxy
+        supporting X-Sendfile, else to the wsgi.file_wrapper of the server,
+        which uses sendfile(2) with gunicorn or uwsgi.
+        """
+
+        stat = os.stat(abs_file)
+        size = stat.st_size
+        etag = "%x-%x-%x" % (stat.st_ino, stat.st_mtime_ns, size)
+        last_modified = http_date(stat.st_mtime)
+
+        mimetype, _ = mimetypes.guess_type(abs_file)
+        if mimetype is None:
+            mimetype = 'application/octet-stream'
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition':
+                content_disposition(os.path.basename(abs_file)),
+            'ETag': quote_etag(etag),
+            'Last-Modified': last_modified,
+        }
+
+        if request.if_none_match.contains(etag):
+            return Response(
+                status=hcodes.HTTP_NOT_MODIFIED,
+                headers=headers, mimetype=mimetype)
+
+        # Offload the whole transfer: the proxy handles ranges by itself
+        if UPLOAD_ACCEL_REDIRECT is not None:
+            relative = os.path.relpath(abs_file, UPLOAD_FOLDER)
+            headers['X-Accel-Redirect'] = \
+                UPLOAD_ACCEL_REDIRECT.rstrip('/') + '/' + relative
+            return Response(headers=headers, mimetype=mimetype)
+        if current_app.use_x_sendfile:
+            headers['X-Sendfile'] = abs_file
+            return Response(headers=headers, mimetype=mimetype)
+
+        code = hcodes.HTTP_OK_BASIC
+        offset = 0
+        length = size
+
+        # A stale If-Range validator means the whole (new) file is sent
+        if_range = request.headers.get('If-Range')
+        use_range = request.range is not None and \
+            (if_range is None or
+             if_range in (quote_etag(etag), last_modified))
+
+        current_range = None
+        if use_range:
+            satisfiable, current_range = requested_range(request.range, size)
+            if not satisfiable:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return Response(
+                    status=hcodes.HTTP_BAD_RANGE_NOT_SATISFIABLE,
+                    headers=headers, mimetype=mimetype)
+
+        if current_range is not None:
+            start, stop = current_range
+            offset = start
+            length = stop - start
+            code = hcodes.HTTP_PARTIAL_CONTENT
+            headers['Content-Range'] = \
+                request.range.to_content_range_header(size)
+
+        headers['Content-Length'] = str(length)
+        log.verbose("Sending %s bytes of %s from offset %s"
+                    % (length, abs_file, offset))
+
+        handle = open(abs_file, 'rb')
+        if offset + length == size:
+            # up to the end of file: safe for any file wrapper
+            handle.seek(offset)
+            body = wrap_file(request.environ, handle, COPY_BUFFER_SIZE)
+        else:
+            body = self.read_range(handle, offset, length)
+
+        return Response(
+            body, status=code, headers=headers, mimetype=mimetype,
+            direct_passthrough=True)
+
+    @staticmethod
+    def read_range(handle, offset, length):
+        try:
+            fd = handle.fileno()
+            while length > 0:
+                data = os.pread(fd, min(COPY_BUFFER_SIZE, length), offset)
+                if not data:
+                    break
+                offset += len(data)
+                length -= len(data)
+                yield data
+        finally:
+            handle.close()
 
     def ngflow_upload(self, filename, destination, content,
                       chunk_number, chunk_size, chunk_total,
-                      overwrite=True
+                      overwrite=True, total_size=None
                       ):
+        """
+        Save one chunk sent by a flow.js (ng-flow) client.
+
+        Chunks may arrive in any order, or concurrently: each one is written
+        at its own offset of a partial file, while the received ones are
+        tracked in a bitmap sidecar. When the last missing chunk is written
+        the partial file is renamed to the final name (abs_fname).
+
+        Returns (abs_fname, sec_filename): abs_fname exists only once
+        the upload is completed, check it with ngflow_completed.
+        Chunks other than the first one, arriving after completion
+        (e.g. client retries) for a file of the same total size,
+        are ignored.
+        """
 
         chunk_number = int(chunk_number)
         chunk_size = int(chunk_size)
@@ -80,24 +410,197 @@ class Uploader(object):
         sec_filename = secure_filename(filename)
         abs_fname = os.path.join(destination, sec_filename)
 
-# TO FIX: what happens if chunk 2 arrives before chunk 1?
-        if overwrite and chunk_number == 1:
-            if os.path.exists(abs_fname):
-                os.remove(abs_fname)
-
-# TO FIX: file is saved as data, not as ASCII/TEXT
-        # with open(abs_fname, "wb") as f:
-        with open(abs_fname, "ab") as f:
-            # log.critical("Copying chunk %d" % chunk_number)
-            # log.critical("Pos = %d" % ((chunk_number - 1) * chunk_size))
-            # f.seek((int(chunk_number) - 1) * int(chunk_size), 0)
-            content.save(f)
-            f.close()
+        if chunk_number < 1 or chunk_number > chunk_total:
+            raise RestApiException(
+                "Invalid chunk number %s (of %s)"
+                % (chunk_number, chunk_total),
+                status_code=hcodes.HTTP_BAD_REQUEST)
+
+        if not overwrite and os.path.exists(abs_fname):
+            raise RestApiException(
+                "File '%s' already exists" % sec_filename,
+                status_code=hcodes.HTTP_BAD_CONFLICT)
+
+        part_fname = abs_fname + PARTIAL_SUFFIX
+        bitmap_fname = abs_fname + CHUNKS_SUFFIX
+        bitmap_size = (chunk_total + 7) // 8
+
+        with self.locked_file(bitmap_fname) as bitmap_fd:
+            bitmap = self.read_bitmap(bitmap_fd)
+            # a late retry of an upload already completed
+            if len(bitmap) == 0 and chunk_number > 1 and \
+               not os.path.exists(part_fname) and \
+               self.ngflow_same_file(abs_fname, total_size):
+                os.remove(bitmap_fname)
+                log.debug("Chunk %s of completed %s ignored"
+                          % (chunk_number, abs_fname))
+                return abs_fname, sec_filename
+            # a new upload is starting with this name
+            if len(bitmap) != bitmap_size or \
+               not os.path.exists(part_fname):
+                bitmap = bytearray(bitmap_size)
+                self.write_bitmap(bitmap_fd, bitmap)
+                fd = os.open(
+                    part_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    if total_size is not None and int(total_size) > 0:
+                        self.preallocate(fd, int(total_size))
+                finally:
+                    os.close(fd)
+
+        # Write the chunk in place, without holding the lock
+        offset = (chunk_number - 1) * chunk_size
+        try:
+            fd = os.open(part_fname, os.O_WRONLY)
+        except FileNotFoundError:
+            # completed meanwhile, this chunk was a duplicate
+            return abs_fname, sec_filename
+        try:
+            while True:
+                data = content.stream.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                view = memoryview(data)
+                while len(view) > 0:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+        finally:
+            os.close(fd)
+
+        with self.locked_file(bitmap_fname, create=False) as bitmap_fd:
+            if bitmap_fd is None:
+                # the bitmap is gone: completed by another request
+                return abs_fname, sec_filename
+            bitmap = self.read_bitmap(bitmap_fd)
+            if len(bitmap) == bitmap_size and os.path.exists(part_fname):
+                index = chunk_number - 1
+                bitmap[index // 8] |= 1 << (index % 8)
+                self.write_bitmap(bitmap_fd, bitmap)
+
+                received = sum(bin(byte).count('1') for byte in bitmap)
+                if received == chunk_total:
+                    os.rename(part_fname, abs_fname)
+                    os.remove(bitmap_fname)
+                    log.info("Upload of %s completed (%s chunks)"
+                             % (abs_fname, chunk_total))
 
         return abs_fname, sec_filename
 
+    def ngflow_chunk_exists(self, filename, destination, chunk_number):
+        """
+        Let a flow.js client (testChunks) skip chunks already received,
+        to resume an upload after a disconnection.
+        """
+
+        chunk_number = int(chunk_number)
+        abs_fname = os.path.join(destination, secure_filename(filename))
+        bitmap_fname = abs_fname + CHUNKS_SUFFIX
+
+        if not os.path.exists(bitmap_fname):
+            return self.ngflow_completed(filename, destination)
+
+        with self.locked_file(bitmap_fname, create=False) as bitmap_fd:
+            if bitmap_fd is None:
+                return self.ngflow_completed(filename, destination)
+            bitmap = self.read_bitmap(bitmap_fd)
+        index = chunk_number - 1
+        if index < 0 or index // 8 >= len(bitmap):
+            return False
+        return bool(bitmap[index // 8] & (1 << (index % 8)))
+
+    @staticmethod
+    def ngflow_same_file(abs_fname, total_size):
+        """ Whether abs_fname may be the result of this upload """
+        try:
+            size = os.path.getsize(abs_fname)
+        except OSError:
+            return False
+        return total_size is None or int(total_size) == size
+
+    def ngflow_completed(self, filename, destination):
+        abs_fname = os.path.join(destination, secure_filename(filename))
+        return os.path.exists(abs_fname) and \
+            not os.path.exists(abs_fname + CHUNKS_SUFFIX)
+
+    @staticmethod
+    @contextmanager
+    def locked_file(fname, create=True):
+        """
+        Exclusive lock on fname, yields its descriptor
+        (None if missing and not created).
+
+        The file may be removed or replaced by the previous holder
+        of the lock: then the lock is taken again on the current one.
+        """
+
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT
+        while True:
+            try:
+                fd = os.open(fname, flags, 0o644)
+            except FileNotFoundError:
+                yield None
+                return
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current = os.stat(fname).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(fd).st_ino:
+                break
+            os.close(fd)
+
+        try:
+            yield fd
+        finally:
+            # closing the descriptor also releases the lock
+            os.close(fd)
+
+    @staticmethod
+    def read_bitmap(fd):
+        size = os.fstat(fd).st_size
+        return bytearray(os.pread(fd, size, 0))
+
+    @staticmethod
+    def write_bitmap(fd, bitmap):
+        os.ftruncate(fd, len(bitmap))
+        os.pwrite(fd, bytes(bitmap), 0)
+
+    @staticmethod
+    def preallocate(fd, size):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            # not supported by this platform or file system
+            os.ftruncate(fd, size)
+
+    def get_upload_owner(self):
+        """ Whom quotas are accounted to: the user, or the client address """
+        try:
+            user = self.get_current_user()
+        except BaseException:
+            user = None
+        if user is None:
+            return request.remote_addr
+        return getattr(user, 'email', None) or str(user)
+
     def upload(self, subfolder=None, force=False):
 
+        # Admission happens before accessing request.files,
+        # which would read the whole body
+        try:
+            with upload_admission.admitted(
+                    self.get_upload_owner(), request.content_length):
+                return self.receive_upload(subfolder, force)
+        except RestApiException as e:
+            log.warning("Upload refused: %s" % e)
+            return self.force_response(
+                errors={"Upload refused": str(e)}, code=e.status_code)
+
+    def receive_upload(self, subfolder=None, force=False):
+
         if 'file' not in request.files:
             return self.force_response(errors={
                 "Missing file": "No files specified"})
@@ -124,7 +627,7 @@ class Uploader(object):
 
             log.warn("Already exists")
             if force:
-                os.remove(abs_file)
+                self.remove_file(abs_file)
                 log.debug("Forced removal")
             else:
                 return self.force_response(
@@ -135,7 +638,10 @@ class Uploader(object):
 
         # Save the file
         try:
-            myfile.save(abs_file)
+            if self.deduplicate:
+                head = self.save_object(myfile.stream, abs_file)
+            else:
+                head = self.save_stream(myfile.stream, abs_file)
             log.debug("Absolute file path should be '%s'" % abs_file)
         except Exception:
             return self.force_response(errors={
@@ -148,16 +654,15 @@ class Uploader(object):
                 "Server file system": "Unable to recover the uploaded file"},
                 code=hcodes.HTTP_DEFAULT_SERVICE_FAIL)
 
-        # Extra info
+        return self.upload_response(filename, abs_file, head)
+
+    def upload_response(self, filename, abs_file, head):
+
+        # Extra info, from the bytes already seen while saving
         ftype = None
         fcharset = None
         try:
-            # Check the type
-            from plumbum.cmd import file
-            out = file["-ib", abs_file]()
-            tmp = out.split(';')
-            ftype = tmp[0].strip()
-            fcharset = tmp[1].split('=')[1].strip()
+            ftype, fcharset = detect_type(head)
         except Exception:
             log.warning("Unknown type for '%s'" % abs_file)
 
@@ -173,6 +678,49 @@ class Uploader(object):
             'meta': {'type': ftype, 'charset': fcharset}
         }, code=hcodes.HTTP_OK_BASIC)
 
+    @staticmethod
+    def save_stream(stream, abs_file, hasher=None):
+        """
+        Copy an uploaded stream to its destination in chunks;
+        returns its first bytes, to detect the file type.
+        """
+
+        head = b''
+        with open(abs_file, 'wb') as target:
+            while True:
+                data = stream.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                if len(head) < SNIFF_SIZE:
+                    head += data[:SNIFF_SIZE - len(head)]
+                if hasher is not None:
+                    hasher.update(data)
+                target.write(data)
+        return head
+
+    def save_object(self, stream, abs_file):
+        """ Hash while saving, then store the content only once """
+
+        folder = self.absolute_object_file()
+        os.makedirs(folder, exist_ok=True)
+        tmp_file = os.path.join(
+            folder, "tmp.%s.%s" % (os.getpid(), threading.get_ident()))
+
+        hasher = hashlib.sha256()
+        try:
+            head = self.save_stream(stream, tmp_file, hasher)
+            self.link_object(hasher.hexdigest(), abs_file, tmp_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return head
+
+    def remove_file(self, abs_file):
+        if self.deduplicate:
+            self.unlink_object(abs_file)
+        else:
+            os.remove(abs_file)
+
     def remove(self, filename, subfolder=None, skip_response=False):
         """ Remove the file if requested """
 
@@ -187,7 +735,7 @@ class Uploader(object):
 
         # Remove the real file
         try:
-            os.remove(abs_file)
+            self.remove_file(abs_file)
         except Exception:
             log.critical("Cannot remove local file %s" % abs_file)
             return self.force_response(errors={
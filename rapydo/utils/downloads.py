@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headers and ranges shared by the endpoints sending files
+(uploaded files and iRODS data objects)
+"""
+
+from urllib.parse import quote
+
+
+def requested_range(request_range, size):
+    """
+    How to answer the Range of a request (werkzeug Range, or None)
+    for a body of 'size' bytes: returns (satisfiable, current_range).
+
+    current_range is the (start, stop) of a single byte range
+    (206 Partial Content), or None to send the whole body (200):
+    multiple ranges and other units are not served as multipart.
+    When not satisfiable the answer is 416.
+    """
+
+    if request_range is None:
+        return True, None
+
+    if request_range.units != 'bytes':
+        return True, None
+
+    if len(request_range.ranges) != 1:
+        for start, _ in request_range.ranges:
+            # suffix ranges (negative start) are always satisfiable
+            if start < 0 and size > 0 or 0 <= start < size:
+                return True, None
+        return False, None
+
+    current_range = request_range.range_for_length(size)
+    if current_range is None:
+        return False, None
+    return True, current_range
+
+
+def content_disposition(filename, disposition='attachment'):
+    """
+    A Content-Disposition header for any file name (RFC 6266):
+    an ascii fallback, plus the UTF-8 name when different
+    """
+
+    fallback = ''.join(
+        '_' if char in '"\\' or ord(char) < 32 or ord(char) > 126
+        else char
+        for char in filename)
+    value = '%s; filename="%s"' % (disposition, fallback)
+    if fallback != filename:
+        value += "; filename*=UTF-8''%s" % quote(filename, safe='')
+    return value
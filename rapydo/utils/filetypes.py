@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Detect the MIME type and charset of a file from its first bytes,
+with the same output of 'file -ib' but without forking a process.
+
+libmagic is used through its python bindings (python-magic),
+if installed; otherwise a pure python sniffer of the most common
+magic numbers is used, with a simple charset detector
+(chardet is used when available).
+
+Compare with the 'file' command on a file:
+    python -m rapydo.utils.filetypes /path/to/file
+"""
+
+import codecs
+import threading
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
+# bytes needed to recognize a type
+SNIFF_SIZE = 8192
+
+UNKNOWN_TYPE = 'application/octet-stream'
+BINARY_CHARSET = 'binary'
+
+# (offset, signature, mime type)
+SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'BM', 'image/x-ms-bmp'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (257, b'ustar', 'application/x-tar'),
+    (0, b'\x89HDF\r\n\x1a\n', 'application/x-hdf'),
+    (0, b'CDF\x01', 'application/x-netcdf'),
+    (0, b'CDF\x02', 'application/x-netcdf'),
+    (0, b'\x7fELF', 'application/x-executable'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'\x00\x00\x01\xba', 'video/mpeg'),
+    (4, b'ftyp', 'video/mp4'),
+]
+
+# text formats recognized by their beginning
+TEXT_PREFIXES = [
+    (b'<?xml', 'text/xml'),
+    (b'<!doctype html', 'text/html'),
+    (b'<html', 'text/html'),
+    (b'#!', 'text/x-shellscript'),
+]
+
+_magic_lock = threading.Lock()
+_magic_instance = None
+
+
+def detect_charset(head, complete=None):
+    """
+    Charset names as reported by libmagic.
+    'complete' tells if head is the whole file (by default: when it is
+    shorter than SNIFF_SIZE), otherwise it may end in the middle of a
+    multi-byte character.
+    """
+
+    if complete is None:
+        complete = len(head) < SNIFF_SIZE
+
+    if len(head) < 1:
+        return BINARY_CHARSET
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if head.startswith(codecs.BOM_UTF16_LE):
+        return 'utf-16le'
+    if head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16be'
+    if b'\x00' in head:
+        return BINARY_CHARSET
+
+    try:
+        head.decode('ascii')
+        return 'us-ascii'
+    except UnicodeDecodeError:
+        pass
+
+    # the head may truncate a multi-byte character at its end
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(
+            head, final=complete)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    if chardet is not None:
+        encoding = chardet.detect(head).get('encoding')
+        if encoding is not None:
+            return encoding.lower()
+
+    # no control characters other than spaces: latin text
+    controls = set(range(0, 32)) - {9, 10, 12, 13, 27}
+    if not any(byte in controls for byte in head):
+        return 'iso-8859-1'
+    return BINARY_CHARSET
+
+
+def sniff_type(head, complete=None):
+    """ A (partial) pure python equivalent of libmagic """
+
+    if len(head) < 1:
+        return 'inode/x-empty', BINARY_CHARSET
+
+    for offset, signature, mimetype in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mimetype, BINARY_CHARSET
+
+    charset = detect_charset(head, complete)
+    if charset == BINARY_CHARSET:
+        return UNKNOWN_TYPE, charset
+
+    beginning = head.lstrip()[:20].lower()
+    for prefix, mimetype in TEXT_PREFIXES:
+        if beginning.startswith(prefix):
+            return mimetype, charset
+
+    return 'text/plain', charset
+
+
+def get_magic():
+    global _magic_instance
+    with _magic_lock:
+        if _magic_instance is None:
+            _magic_instance = magic.Magic(mime=True, mime_encoding=True)
+        return _magic_instance
+
+
+def detect_type(head, complete=None):
+    """
+    MIME type and charset from the first bytes (SNIFF_SIZE)
+    of a file, e.g. ('text/plain', 'us-ascii')
+    """
+
+    head = head[:SNIFF_SIZE]
+
+    if magic is not None:
+        try:
+            instance = get_magic()
+            with _magic_lock:
+                out = instance.from_buffer(head)
+            tmp = out.split(';')
+            return tmp[0].strip(), tmp[1].split('=')[1].strip()
+        except Exception:
+            pass
+
+    return sniff_type(head, complete)
+
+
+def benchmark(path, repeat=100):
+    """ In-process detection against a 'file -ib' process for each call """
+
+    import time
+    from plumbum.cmd import file
+
+    with open(path, 'rb') as handle:
+        head = handle.read(SNIFF_SIZE)
+
+    start = time.time()
+    for _ in range(repeat):
+        in_process = detect_type(head)
+    in_process_time = (time.time() - start) / repeat
+
+    start = time.time()
+    for _ in range(repeat):
+        out = file["-ib", path]()
+    fork_time = (time.time() - start) / repeat
+
+    print("in process: %s (%.6f s/file)" % (in_process, in_process_time))
+    print("file -ib: %s (%.6f s/file)" % (out.strip(), fork_time))
+    print("speedup: %.1fx" % (fork_time / max(in_process_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(sys.argv[1])
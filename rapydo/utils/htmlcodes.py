@@ -40,6 +40,9 @@ HTTP_BAD_NOTFOUND = 404
 HTTP_BAD_METHOD_NOT_ALLOWED = 405
 HTTP_BAD_CONFLICT = 409
 HTTP_BAD_RESOURCE = 410
+HTTP_BAD_LENGTH_REQUIRED = 411
+HTTP_BAD_REQUEST_ENTITY_TOO_LARGE = 413
+HTTP_BAD_RANGE_NOT_SATISFIABLE = 416
 
 # SERVER ERROR
 HTTP_SERVER_ERROR = 500
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counters and latency histograms for the services in use,
+with a bounded log of the slowest calls.
+
+Every service keeps its own (thread safe) set of metrics:
+
+    from rapydo.utils.metrics import get_metrics
+    metrics = get_metrics('irods')
+    metrics.observe('data_objects.get', elapsed, path=path)
+
+A snapshot of everything is published by the Metrics endpoint.
+"""
+
+import time
+import threading
+from collections import deque
+
+# upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+DEFAULT_SLOW_THRESHOLD = 1.0
+DEFAULT_SLOW_CALLS = 100
+
+
+class ServiceMetrics(object):
+
+    def __init__(self, name,
+                 buckets=DEFAULT_BUCKETS, slow_calls=DEFAULT_SLOW_CALLS):
+        self.name = name
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._gauges = {}
+        self._slow_calls = deque(maxlen=slow_calls)
+
+    def observe(self, operation, elapsed, failed=False,
+                threshold=DEFAULT_SLOW_THRESHOLD, **details):
+        """ Account a call; slow ones are also kept with their details """
+
+        with self._lock:
+
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = {
+                    'count': 0,
+                    'errors': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+                self._operations[operation] = stats
+
+            stats['count'] += 1
+            if failed:
+                stats['errors'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+            position = len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    position = index
+                    break
+            stats['histogram'][position] += 1
+
+            if threshold is not None and elapsed >= threshold:
+                call = dict(details)
+                call['operation'] = operation
+                call['elapsed'] = elapsed
+                call['failed'] = failed
+                call['timestamp'] = time.time()
+                self._slow_calls.append(call)
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+
+        with self._lock:
+
+            operations = {}
+            labels = ["<=%s" % bound for bound in self.buckets]
+            labels.append(">%s" % self.buckets[-1])
+
+            for operation, stats in self._operations.items():
+                data = dict(stats)
+                data['average_time'] = stats['total_time'] / stats['count']
+                data['histogram'] = dict(zip(labels, stats['histogram']))
+                operations[operation] = data
+
+            return {
+                'operations': operations,
+                'gauges': dict(self._gauges),
+                'slow_calls': list(self._slow_calls),
+            }
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_metrics(name):
+    with _registry_lock:
+        metrics = _registry.get(name)
+        if metrics is None:
+            metrics = ServiceMetrics(name)
+            _registry[name] = metrics
+        return metrics
+
+
+def get_all_metrics():
+    with _registry_lock:
+        services = list(_registry.values())
+    return {metrics.name: metrics.snapshot() for metrics in services}
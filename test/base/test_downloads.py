@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the headers and ranges of file downloads
+"""
+
+import unittest
+from rapydo.utils.downloads import requested_range, content_disposition
+
+
+class Range(object):
+    """ The interface of a werkzeug Range, as parsed from the request """
+
+    def __init__(self, ranges, units='bytes'):
+        self.units = units
+        self.ranges = ranges
+
+    def range_for_length(self, length):
+        if self.units != 'bytes' or len(self.ranges) != 1:
+            return None
+        start, end = self.ranges[0]
+        if end is None:
+            end = length
+            if start < 0:
+                start += length
+        if 0 <= start < length:
+            return start, min(end, length)
+        return None
+
+
+class DownloadsTests(unittest.TestCase):
+
+    def test_01_single_range(self):
+
+        self.assertEqual(requested_range(None, 100), (True, None))
+        self.assertEqual(
+            requested_range(Range([(0, 10)]), 100), (True, (0, 10)))
+        self.assertEqual(
+            requested_range(Range([(-10, None)]), 100), (True, (90, 100)))
+        self.assertEqual(
+            requested_range(Range([(200, None)]), 100), (False, None))
+
+    def test_02_whole_body(self):
+
+        # multiple ranges are answered with the whole body
+        self.assertEqual(
+            requested_range(Range([(0, 10), (20, 30)]), 100), (True, None))
+        self.assertEqual(
+            requested_range(Range([(200, 210), (-5, None)]), 100),
+            (True, None))
+        self.assertEqual(
+            requested_range(Range([(200, 210), (300, None)]), 100),
+            (False, None))
+        self.assertEqual(
+            requested_range(Range([(0, 10)], units='items'), 100),
+            (True, None))
+
+    def test_03_content_disposition(self):
+
+        self.assertEqual(
+            content_disposition('data.txt'),
+            'attachment; filename="data.txt"')
+        self.assertEqual(
+            content_disposition('say "hi".txt'),
+            'attachment; filename="say _hi_.txt"; '
+            "filename*=UTF-8''say%20%22hi%22.txt")
+        value = content_disposition('caffè.txt')
+        value.encode('latin-1')
+        self.assertEqual(
+            value,
+            'attachment; filename="caff_.txt"; '
+            "filename*=UTF-8''caff%C3%A8.txt")
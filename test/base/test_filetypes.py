@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the in process detection of file types
+"""
+
+import unittest
+from rapydo.utils import filetypes
+from rapydo.utils.filetypes import detect_charset, sniff_type, SNIFF_SIZE
+
+
+class FileTypesTests(unittest.TestCase):
+
+    def test_01_charsets(self):
+
+        self.assertEqual(detect_charset(b''), 'binary')
+        self.assertEqual(detect_charset(b'hello\n'), 'us-ascii')
+        self.assertEqual(detect_charset(b'caff\xc3\xa8\n'), 'utf-8')
+        self.assertEqual(detect_charset(b'\x00\x01\x02'), 'binary')
+
+    def test_02_truncated_utf8(self):
+
+        # a multi-byte character cut by the end of the head
+        head = b'a' * (SNIFF_SIZE - 1) + b'\xc3'
+        self.assertEqual(detect_charset(head), 'utf-8')
+
+        # the whole file, ending with an invalid byte
+        self.assertNotEqual(detect_charset(b'caff\xe8'), 'utf-8')
+        self.assertNotEqual(
+            detect_charset(b'caff\xc3', complete=True), 'utf-8')
+
+    def test_03_signatures(self):
+
+        self.assertEqual(
+            sniff_type(b'\x89PNG\r\n\x1a\n' + b'\x00' * 10),
+            ('image/png', 'binary'))
+        self.assertEqual(
+            sniff_type(b'%PDF-1.4\n'), ('application/pdf', 'binary'))
+        self.assertEqual(sniff_type(b''), ('inode/x-empty', 'binary'))
+
+    def test_04_text_formats(self):
+
+        self.assertEqual(
+            sniff_type(b'<?xml version="1.0"?><a/>'),
+            ('text/xml', 'us-ascii'))
+        self.assertEqual(
+            sniff_type(b'#!/bin/bash\necho\n'),
+            ('text/x-shellscript', 'us-ascii'))
+        self.assertEqual(
+            sniff_type(b'just some text\n'), ('text/plain', 'us-ascii'))
+
+    def test_05_libmagic_failures(self):
+
+        class BrokenMagic(object):
+            def from_buffer(self, head):
+                raise RuntimeError("broken")
+
+        saved = filetypes.magic, filetypes._magic_instance
+        filetypes.magic = True
+        filetypes._magic_instance = BrokenMagic()
+        try:
+            self.assertEqual(
+                filetypes.detect_type(b'hello\n'),
+                ('text/plain', 'us-ascii'))
+        finally:
+            filetypes.magic, filetypes._magic_instance = saved
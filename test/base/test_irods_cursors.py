@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the paging helpers and caches of the iRODS client
+(no iRODS server needed)
+"""
+
+import unittest
+from flask_ext.flask_irods.client import \
+    IrodsPythonClient, IrodsException, UsersCache
+
+
+class FakeQuery(object):
+    """ The paging interface of a GenQuery, on a list of rows """
+
+    def __init__(self, rows, start=0, size=None):
+        self.rows = rows
+        self.start = start
+        self.size = size
+        self.executed = 0
+
+    def offset(self, offset):
+        return FakeQuery(self.rows, offset, self.size)
+
+    def limit(self, limit):
+        return FakeQuery(self.rows, self.start, limit)
+
+    def get_results(self):
+        self.executed += 1
+        end = None
+        if self.size is not None:
+            end = self.start + self.size
+        return iter(self.rows[self.start:end])
+
+
+class IrodsCursorsTests(unittest.TestCase):
+
+    def setUp(self):
+        # the helpers don't need a connection
+        self.client = IrodsPythonClient.__new__(IrodsPythonClient)
+
+    def test_01_cursors(self):
+
+        for kind in (self.client.CURSOR_COLLECTIONS,
+                     self.client.CURSOR_DATAOBJECTS):
+            cursor = self.client.encode_cursor(kind, 42)
+            self.assertEqual(self.client.decode_cursor(cursor), (kind, 42))
+
+        self.assertEqual(
+            self.client.decode_cursor(None),
+            (self.client.CURSOR_COLLECTIONS, 0))
+
+        for invalid in ('', 'not a cursor', 'eDox'):
+            with self.assertRaises(IrodsException):
+                self.client.decode_cursor(invalid)
+
+    def test_02_paged_queries(self):
+
+        direct = FakeQuery(['a', 'b', 'c'])
+        subtree = FakeQuery(['d', 'e', 'f', 'g'])
+        queries = [direct, subtree]
+
+        pages = []
+        counts = {}
+        offset = 0
+        while True:
+            page = self.client.paged_queries(queries, offset, 2, counts)
+            pages.append(page)
+            offset += len(page)
+            if len(page) < 2:
+                break
+
+        self.assertEqual(
+            pages, [['a', 'b'], ['c', 'd'], ['e', 'f'], ['g']])
+        # each skipped query is counted only once
+        self.assertEqual(counts, {0: 3, 1: 4})
+
+    def test_03_paged_queries_offsets(self):
+
+        queries = [FakeQuery(['a', 'b', 'c']), FakeQuery(['d', 'e'])]
+        self.assertEqual(
+            self.client.paged_queries(queries, 3), ['d', 'e'])
+        self.assertEqual(
+            self.client.paged_queries(queries, 2, 2), ['c', 'd'])
+        self.assertEqual(self.client.paged_queries(queries, 10), [])
+
+    def test_04_subtree_prefix(self):
+
+        self.assertEqual(self.client.subtree_prefix('/zone/home'),
+                         '/zone/home/')
+        self.assertEqual(self.client.subtree_prefix('/'), '/')
+
+    def test_05_in_subtree(self):
+
+        in_subtree = self.client.in_subtree
+        self.assertTrue(in_subtree('/zone/a_b', '/zone/a_b/c'))
+        self.assertTrue(in_subtree('/zone/a_b', '/zone/a_b/c/d'))
+        # wildcards of Like() and siblings with the same prefix
+        self.assertFalse(in_subtree('/zone/a_b', '/zone/aXb/c'))
+        self.assertFalse(in_subtree('/zone/a_b', '/zone/a_bc/d'))
+        self.assertFalse(in_subtree('/zone/a_b', '/zone/a_b'))
+        self.assertTrue(in_subtree('/', '/zone'))
+        self.assertFalse(in_subtree('/', '/'))
+
+    def test_06_users_cache(self):
+
+        cache = UsersCache(max_size=3)
+        for index in range(5):
+            cache.set('zone', 'user%s' % index, index)
+        self.assertEqual(len(cache._data), 3)
+        # the oldest ones are dropped
+        self.assertIs(cache.get('zone', 'user0'), UsersCache.MISSING)
+        self.assertEqual(cache.get('zone', 'user4'), 4)
+
+        # expired entries go first
+        cache = UsersCache(max_size=3)
+        cache.set('zone', 'old', 1)
+        cache.set('zone', 'expired', None, ttl=-1)
+        cache.set('zone', 'new', 2)
+        cache.set('zone', 'newer', 3)
+        self.assertEqual(cache.get('zone', 'old'), 1)
+        self.assertIs(cache.get('zone', 'expired'), UsersCache.MISSING)
+        self.assertNotIn(('zone', 'expired'), cache._data)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the service metrics
+"""
+
+import unittest
+from rapydo.utils.metrics import ServiceMetrics
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_01_observe(self):
+
+        metrics = ServiceMetrics('test', buckets=(0.1, 1))
+        metrics.observe('get', 0.05, threshold=None)
+        metrics.observe('get', 0.5, threshold=None)
+        metrics.observe('get', 2, failed=True, threshold=None)
+
+        stats = metrics.snapshot()['operations']['get']
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['max_time'], 2)
+        self.assertAlmostEqual(stats['average_time'], 2.55 / 3)
+        self.assertEqual(
+            stats['histogram'], {'<=0.1': 1, '<=1': 1, '>1': 1})
+
+    def test_02_slow_calls(self):
+
+        metrics = ServiceMetrics('test', slow_calls=2)
+        metrics.observe('get', 0.1, threshold=1, path='/fast')
+        for index in range(3):
+            metrics.observe('put', 5, threshold=1, path='/slow%s' % index)
+
+        slow = metrics.snapshot()['slow_calls']
+        # only the latest ones are kept
+        self.assertEqual(
+            [call['path'] for call in slow], ['/slow1', '/slow2'])
+        self.assertEqual(slow[0]['operation'], 'put')
+
+    def test_03_gauges(self):
+
+        metrics = ServiceMetrics('test')
+        metrics.set_gauge('pool', 3)
+        metrics.set_gauge('pool', 4)
+        self.assertEqual(metrics.snapshot()['gauges'], {'pool': 4})
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the assembly of chunked (ng-flow) uploads,
+the deduplicated storage and the upload admission control
+(temporary folders only, no services needed)
+"""
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from rapydo.services import uploader as uploader_module
+from rapydo.services.uploader import Uploader, UploadAdmission, \
+    CHUNKS_SUFFIX, PARTIAL_SUFFIX
+from rapydo.exceptions import RestApiException
+from rapydo.utils import htmlcodes as hcodes
+
+
+class Chunk(object):
+    """ What ng-flow endpoints receive: a file with a stream """
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+
+class ChunkedUploadTests(unittest.TestCase):
+
+    chunk_size = 10
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.uploader = Uploader()
+        self.data = bytes(random.getrandbits(8) for _ in range(95))
+        self.chunks = [
+            self.data[start:start + self.chunk_size]
+            for start in range(0, len(self.data), self.chunk_size)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def send(self, number, filename='data.bin'):
+        return self.uploader.ngflow_upload(
+            filename, self.folder, Chunk(self.chunks[number - 1]),
+            number, self.chunk_size, len(self.chunks),
+            total_size=len(self.data))
+
+    def assertCompleted(self, filename='data.bin'):
+        abs_fname = os.path.join(self.folder, filename)
+        self.assertTrue(
+            self.uploader.ngflow_completed(filename, self.folder))
+        with open(abs_fname, 'rb') as handle:
+            self.assertEqual(handle.read(), self.data)
+        self.assertFalse(os.path.exists(abs_fname + PARTIAL_SUFFIX))
+        self.assertFalse(os.path.exists(abs_fname + CHUNKS_SUFFIX))
+
+    def test_01_in_order(self):
+
+        for number in range(1, len(self.chunks) + 1):
+            self.assertFalse(
+                self.uploader.ngflow_completed('data.bin', self.folder))
+            abs_fname, filename = self.send(number)
+
+        self.assertEqual(abs_fname, os.path.join(self.folder, 'data.bin'))
+        self.assertEqual(filename, 'data.bin')
+        self.assertCompleted()
+
+    def test_02_out_of_order(self):
+
+        numbers = list(range(1, len(self.chunks) + 1))
+        random.shuffle(numbers)
+        for number in numbers:
+            self.send(number)
+        self.assertCompleted()
+
+    def test_03_concurrent(self):
+
+        threads = [
+            threading.Thread(target=self.send, args=(number, ))
+            for number in range(1, len(self.chunks) + 1)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertCompleted()
+
+    def test_04_resume(self):
+
+        self.send(1)
+        self.send(3)
+        exists = self.uploader.ngflow_chunk_exists
+        self.assertTrue(exists('data.bin', self.folder, 1))
+        self.assertFalse(exists('data.bin', self.folder, 2))
+        self.assertTrue(exists('data.bin', self.folder, 3))
+
+        for number in range(2, len(self.chunks) + 1):
+            self.send(number)
+        self.assertCompleted()
+        self.assertTrue(exists('data.bin', self.folder, 2))
+
+    def test_05_late_retries(self):
+
+        for number in range(1, len(self.chunks) + 1):
+            self.send(number)
+
+        # a client retrying chunks of the completed upload
+        self.send(2)
+        self.send(len(self.chunks))
+        self.assertCompleted()
+
+
+class DeduplicatedStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        patcher = mock.patch.object(
+            uploader_module, 'UPLOAD_FOLDER', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.uploader = Uploader()
+        self.uploader.deduplicate = True
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def save(self, filename, data):
+        abs_file = os.path.join(self.folder, filename)
+        head = self.uploader.save_object(io.BytesIO(data), abs_file)
+        self.assertEqual(head, data[:len(head)])
+        return abs_file
+
+    def stored_objects(self):
+        objects = []
+        folder = self.uploader.absolute_object_file()
+        for current, _, files in os.walk(folder):
+            for name in files:
+                if name != uploader_module.OBJECTS_LOCK:
+                    objects.append(os.path.join(current, name))
+        return objects
+
+    def test_01_reference_counting(self):
+
+        first = self.save('first.txt', b'same content')
+        second = self.save('second.txt', b'same content')
+        other = self.save('other.txt', b'other content')
+
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(other).st_ino)
+        self.assertEqual(len(self.stored_objects()), 2)
+        # stored contents are shared: never written in place
+        self.assertEqual(os.stat(first).st_mode & 0o222, 0)
+
+        self.uploader.remove_file(first)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(len(self.stored_objects()), 2)
+        with open(second, 'rb') as handle:
+            self.assertEqual(handle.read(), b'same content')
+
+        self.uploader.remove_file(second)
+        self.uploader.remove_file(other)
+        self.assertEqual(self.stored_objects(), [])
+
+    def test_02_files_not_deduplicated(self):
+
+        # e.g. chunked uploads, or files saved before deduplication
+        abs_file = os.path.join(self.folder, 'plain.txt')
+        with open(abs_file, 'wb') as handle:
+            handle.write(b'plain content')
+
+        # removed without hashing it
+        with mock.patch('hashlib.sha256') as sha256:
+            self.uploader.remove_file(abs_file)
+            sha256.assert_not_called()
+        self.assertFalse(os.path.exists(abs_file))
+
+
+class UploadAdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertRefused(self, admission, user, size, status_code):
+        with self.assertRaises(RestApiException) as context:
+            admission.acquire(user, size, self.folder)
+        self.assertEqual(context.exception.status_code, status_code)
+
+    def test_01_no_limits(self):
+
+        admission = UploadAdmission(0, 0, 0, 0)
+        # no length needed, and no folder checks
+        missing = os.path.join(self.folder, 'missing')
+        tickets = [admission.acquire('user', None, missing)
+                   for _ in range(10)]
+        for ticket in tickets:
+            admission.release(ticket)
+        self.assertEqual(admission._slots, {})
+
+    def test_02_concurrent_uploads(self):
+
+        admission = UploadAdmission(max_concurrent=2, max_user_bytes=0,
+                                    max_total_bytes=0, min_free_bytes=0)
+        first = admission.acquire('user', 10, self.folder)
+        admission.acquire('user', 10, self.folder)
+        self.assertRefused(
+            admission, 'user', 10, hcodes.HTTP_SERVICE_UNAVAILABLE)
+        # other users have their own slots
+        admission.acquire('other', 10, self.folder)
+
+        admission.release(first)
+        admission.acquire('user', 10, self.folder)
+
+    def test_03_bytes_quotas(self):
+
+        admission = UploadAdmission(max_concurrent=0, max_user_bytes=100,
+                                    max_total_bytes=150, min_free_bytes=0)
+        self.assertRefused(
+            admission, 'user', None, hcodes.HTTP_BAD_LENGTH_REQUIRED)
+        self.assertRefused(
+            admission, 'user', 101,
+            hcodes.HTTP_BAD_REQUEST_ENTITY_TOO_LARGE)
+
+        ticket = admission.acquire('user', 80, self.folder)
+        self.assertRefused(
+            admission, 'user', 30, hcodes.HTTP_SERVICE_UNAVAILABLE)
+        admission.acquire('other', 70, self.folder)
+        # the global quota is full
+        self.assertRefused(
+            admission, 'third', 10, hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+        admission.release(ticket)
+        admission.acquire('third', 10, self.folder)
+
+    def test_04_free_space(self):
+
+        admission = UploadAdmission(max_concurrent=0, max_user_bytes=0,
+                                    max_total_bytes=0,
+                                    min_free_bytes=2 ** 62)
+        self.assertRefused(
+            admission, 'user', 10, hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+        missing = os.path.join(self.folder, 'missing')
+        with self.assertRaises(RestApiException) as context:
+            admission.acquire('user', 10, missing)
+        self.assertEqual(context.exception.status_code,
+                         hcodes.HTTP_SERVICE_UNAVAILABLE)
+
+    def test_05_release_on_errors(self):
+
+        admission = UploadAdmission(1, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            with admission.admitted('user', 10, self.folder):
+                raise ValueError("broken upload")
+        admission.acquire('user', 10, self.folder)